@@ -0,0 +1,334 @@
+"""Benchmarks of miscset hot paths.
+
+Generate synthetic data (directory trees, text, csv, yaml and json files,
+tables, and shell commands), time the methods working on them, and record
+throughput and peak memory. Results can be saved as a baseline and compared
+to later runs, to identify performance regressions.
+
+The suite uses the standard library only and runs offline.
+Run it from the repository root with::
+
+    python -m benchmarks.run --size small --save benchmarks.json
+    python -m benchmarks.run --size small --compare benchmarks.json
+
+The size `large` creates multi-GB files, take care of the available disk space.
+"""
+
+
+import os
+import sys
+import gc
+import time
+import random
+import shutil
+import argparse
+import datetime
+import platform
+import statistics
+import tempfile
+import tracemalloc
+
+import miscset
+
+
+SCALES = {"small": 1, "medium": 10, "large": 200}
+"""Factors applied to the size of the generated data."""
+
+
+BENCHMARKS = {}
+"""Benchmark names mapped to setup functions."""
+
+
+def benchmark(name):
+    """Register a benchmark setup function.
+
+    The setup function is called with a working folder and a scale factor.
+    It generates its data and returns a tuple of the function to time
+    (called without arguments), the amount of units processed per call,
+    and the name of the unit.
+    """
+    def decorator(func):
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+### data generators
+
+
+def make_tree(root, depth, width, files):
+    """Create a folder tree with `width` sub folders per level and `files` files per folder."""
+    count = 0
+    folders = [root]
+    for level in range(depth + 1):
+        children = []
+        for folder in folders:
+            os.makedirs(folder, exist_ok = True)
+            for i in range(files):
+                ext = (".txt", ".csv", ".yml", ".tif")[i % 4]
+                open(os.path.join(folder, f"file{i}{ext}"), "w").close()
+                count += 1
+            if level < depth:
+                children += [os.path.join(folder, f"dir{j}") for j in range(width)]
+        folders = children
+    return count
+
+
+def make_text(path, lines, width = 100, seed = 0):
+    """Create a text file of random printable lines."""
+    rng = random.Random(seed)
+    alphabet = "abcdefghijklmnopqrstuvwxyz0123456789 "
+    block = [ "".join(rng.choice(alphabet) for _ in range(width)) for _ in range(1000) ]
+    with open(path, "w") as fs:
+        for i in range(0, lines, 1000):
+            fs.write("\n".join(block[:min(1000, lines - i)]) + "\n")
+    return os.path.getsize(path)
+
+
+def make_csv(path, rows, cols = 10, seed = 0):
+    """Create a csv file of random numbers and words."""
+    rng = random.Random(seed)
+    header = ",".join(f"col{i}" for i in range(cols))
+    block = [ ",".join(str(rng.random()) if i % 2 else f"w{rng.randrange(1000)}"
+        for i in range(cols)) for _ in range(1000) ]
+    with open(path, "w") as fs:
+        fs.write(header + "\n")
+        for i in range(0, rows, 1000):
+            fs.write("\n".join(block[:min(1000, rows - i)]) + "\n")
+    return os.path.getsize(path)
+
+
+def make_document(items, seed = 0):
+    """Create a nested dictionary, as found in large yaml or json files."""
+    rng = random.Random(seed)
+    return {
+        "name": "benchmark",
+        "items": [ {"id": i, "value": rng.random(), "tags": [f"t{rng.randrange(10)}" for _ in range(3)],
+            "nested": {"a": i, "b": str(i), "c": None}} for i in range(items) ],
+    }
+
+
+def make_table(rows, cols, seed = 0):
+    """Create a list of columns with random values."""
+    rng = random.Random(seed)
+    return [ [rng.random() for _ in range(rows)] for _ in range(cols) ]
+
+
+### benchmarks
+
+
+@benchmark("files.find")
+def bench_find(folder, scale):
+    root = os.path.join(folder, "tree")
+    count = make_tree(root, 3, 4, 10 * scale)
+    return lambda: miscset.files.find(root, extensions = ["csv"]), count, "entries"
+
+
+@benchmark("io.read_lines")
+def bench_read_lines(folder, scale):
+    path = os.path.join(folder, "lines.txt")
+    size = make_text(path, 100000 * scale)
+    return lambda: miscset.io.read_lines(path), size, "bytes"
+
+
+@benchmark("io.read_yaml")
+def bench_read_yaml(folder, scale):
+    import yaml
+    path = os.path.join(folder, "document.yml")
+    with open(path, "w") as fs:
+        yaml.safe_dump(make_document(1000 * scale), fs)
+    return lambda: miscset.io.read_yaml(path), os.path.getsize(path), "bytes"
+
+
+@benchmark("io.read_json")
+def bench_read_json(folder, scale):
+    path = os.path.join(folder, "document.json")
+    miscset.io.write_json(path, make_document(10000 * scale))
+    return lambda: miscset.io.read_json(path), os.path.getsize(path), "bytes"
+
+
+@benchmark("io.write_json")
+def bench_write_json(folder, scale):
+    path = os.path.join(folder, "written.json")
+    document = make_document(10000 * scale)
+    miscset.io.write_json(path, document)
+    return lambda: miscset.io.write_json(path, document), os.path.getsize(path), "bytes"
+
+
+@benchmark("io.read_csv")
+def bench_read_csv(folder, scale):
+    path = os.path.join(folder, "table.csv")
+    size = make_csv(path, 100000 * scale)
+    return lambda: miscset.io.read_csv(path), size, "bytes"
+
+
+@benchmark("tables.list_to_df")
+def bench_list_to_df(folder, scale):
+    lol = make_table(10000 * scale, 20)
+    return lambda: miscset.tables.list_to_df(lol), 10000 * scale * 20, "cells"
+
+
+@benchmark("tables.df_to_list")
+def bench_df_to_list(folder, scale):
+    df = miscset.tables.list_to_df(make_table(10000 * scale, 20))
+    return lambda: miscset.tables.df_to_list(df), df.size, "cells"
+
+
+@benchmark("tables.df_to_dict")
+def bench_df_to_dict(folder, scale):
+    df = miscset.tables.list_to_df(make_table(1000 * scale, 200))
+    return lambda: miscset.tables.df_to_dict(df), df.size, "cells"
+
+
+@benchmark("dt.format")
+def bench_dt_format(folder, scale):
+    now = datetime.datetime(2000, 1, 1)
+    n = 10000 * scale
+    def run():
+        for _ in range(n):
+            miscset.dt.format(now, "f")
+    return run, n, "calls"
+
+
+@benchmark("dt.now")
+def bench_dt_now(folder, scale):
+    n = 10000 * scale
+    def run():
+        for _ in range(n):
+            miscset.dt.now("f")
+    return run, n, "calls"
+
+
+@benchmark("dt.parse_many")
+def bench_dt_parse_many(folder, scale):
+    start = datetime.datetime(2000, 1, 1)
+    n = 100000 * scale
+    stamps = [ miscset.dt.format(start + datetime.timedelta(seconds = i), "f") for i in range(n) ]
+    return lambda: miscset.dt.parse_many(stamps, "f"), n, "stamps"
+
+
+@benchmark("sh.run")
+def bench_sh_run(folder, scale):
+    n = 10 * scale
+    def run():
+        for _ in range(n):
+            miscset.sh.run("true")
+    return run, n, "calls"
+
+
+### runner
+
+
+def measure(func, repeat):
+    """Time a function and trace its peak memory.
+
+    Returns:
+        dict: Minimum and median seconds of `repeat` calls,
+            and the peak memory (bytes) allocated by one extra call.
+    """
+    times = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"min": min(times), "median": statistics.median(times), "peak": peak}
+
+
+def run(names = None, size = "small", repeat = 5, folder = None):
+    """Run benchmarks.
+
+    Args:
+        names (list): Benchmark names to run, `None` for all.
+        size (str): One of the keys of :py:data:`SCALES`.
+        repeat (int): Number of timed calls per benchmark.
+        folder (str): Folder for generated data, `None` for a temporary one.
+
+    Returns:
+        dict: Benchmark names mapped to their measurements.
+    """
+    scale = SCALES[size]
+    names = names or list(BENCHMARKS)
+    cleanup = folder is None
+    if folder is None:
+        folder = tempfile.mkdtemp(prefix = "miscset-bench-")
+    results = {}
+    try:
+        for name in names:
+            func, units, unit = BENCHMARKS[name](folder, scale)
+            result = measure(func, repeat)
+            result["units"] = units
+            result["unit"] = unit
+            result["throughput"] = units / result["median"]
+            results[name] = result
+            miscset.io.write_stderr("{:20} {:12.4g} {}/s {:10.4g} s {:8.1f} MiB".format(
+                name, result["throughput"], unit, result["median"], result["peak"] / 2**20))
+    finally:
+        if cleanup:
+            shutil.rmtree(folder, ignore_errors = True)
+    return results
+
+
+def compare(results, baseline, tolerance = 0.2):
+    """Compare results to a baseline.
+
+    Args:
+        results (dict): Results from :func:`run`.
+        baseline (dict): Results from an earlier :func:`run`.
+        tolerance (float): Allowed relative slowdown of the median time.
+
+    Returns:
+        list: Names of benchmarks slower than the baseline.
+    """
+    slower = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["median"] / baseline[name]["median"]
+        memory = result["peak"] / max(baseline[name]["peak"], 1)
+        flag = ""
+        if ratio > 1 + tolerance:
+            slower.append(name)
+            flag = " REGRESSION"
+        miscset.io.write_stderr("{:20} time x{:.2f} memory x{:.2f}{}".format(name, ratio, memory, flag))
+    return slower
+
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description = "Run miscset benchmarks.")
+    parser.add_argument("names", nargs = "*", help = "benchmarks to run (default: all)")
+    parser.add_argument("--size", default = "small", choices = list(SCALES))
+    parser.add_argument("--repeat", type = int, default = 5)
+    parser.add_argument("--folder", help = "folder for generated data")
+    parser.add_argument("--save", help = "write results to a json file")
+    parser.add_argument("--compare", help = "compare results to a json file")
+    parser.add_argument("--tolerance", type = float, default = 0.2)
+    parser.add_argument("--list", action = "store_true", help = "list benchmarks and exit")
+    args = parser.parse_args(args)
+    if args.list:
+        miscset.io.write_stdout(os.linesep.join(BENCHMARKS))
+        return 0
+    results = run(args.names, args.size, args.repeat, args.folder)
+    if args.save:
+        miscset.io.write_json(args.save, {
+            "size": args.size,
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        })
+    if args.compare:
+        baseline = miscset.io.read_json(args.compare)
+        if baseline.get("size") != args.size:
+            miscset.io.write_stderr("baseline size {} differs from {}".format(baseline.get("size"), args.size))
+        if compare(results, baseline["results"], args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -63,6 +63,7 @@ from . import dt
 from . import io
 from . import sh
 from . import files
+from . import metrics
 from . import tables
 from ._version import version
 
@@ -4,11 +4,46 @@
 """Date and time methods.
 
 For convenience, wrap a simpler date/time format to retrieve standardized strings from
-a pythone datetime object, or directly from the current system time.
+a pythone datetime object, or directly from the current system time,
+and parse such strings back to datetime objects.
 """
 
 
+import re
+import time
 import datetime
+import operator
+import numpy
+
+
+FORMATS = {
+    "dt": "%Y-%m-%d %H:%M:%S",
+    "d": "%Y-%m-%d",
+    "t": "%H:%M:%S",
+    "f": "%Y-%m-%d_%H-%M-%S",
+    "n": "%Y%m%d%H%M%S",
+}
+"""Simplified format codes mapped to :py:meth:`datetime.datetime.strftime` formats."""
+
+
+# string width, field positions and separator positions of simplified formats
+_LAYOUTS = {
+    "dt": (19, {"Y": 0, "m": 5, "d": 8, "H": 11, "M": 14, "S": 17},
+        {4: "-", 7: "-", 10: " ", 13: ":", 16: ":"}),
+    "d": (10, {"Y": 0, "m": 5, "d": 8}, {4: "-", 7: "-"}),
+    "t": (8, {"H": 0, "M": 3, "S": 6}, {2: ":", 5: ":"}),
+    "f": (19, {"Y": 0, "m": 5, "d": 8, "H": 11, "M": 14, "S": 17},
+        {4: "-", 7: "-", 10: "_", 13: "-", 16: "-"}),
+    "n": (14, {"Y": 0, "m": 4, "d": 6, "H": 8, "M": 10, "S": 12}, {}),
+}
+
+
+# match ASCII digits in field positions and the expected separators in between
+_PATTERNS = {
+    fmt: re.compile("".join(
+        re.escape(separators[i]) if i in separators else "[0-9]" for i in range(width)))
+    for fmt, (width, fields, separators) in _LAYOUTS.items()
+}
 
 
 def format(dt, fmt = "dt", simplified = True):
@@ -52,25 +87,15 @@ def format(dt, fmt = "dt", simplified = True):
         print(f"or to: {nowstr}")
     """
     if simplified:
-        fmt = fmt.lower()
-        if fmt == "dt":
-            fmt = "%Y-%m-%d %H:%M:%S"
-        elif fmt == "d":
-            fmt = "%Y-%m-%d"
-        elif fmt == "t":
-            fmt = "%H:%M:%S"
-        elif fmt == "f":
-            fmt = "%Y-%m-%d_%H-%M-%S"
-        elif fmt == "n":
-            fmt = "%Y%m%d%H%M%S"
-        else:
-            fmt = ""
+        fmt = FORMATS.get(fmt.lower(), "")
     return dt.strftime(fmt)
 
 
 def now(fmt = "dt", simplified = True):
     """Obtain the current time as string.
 
+    Uses a :class:`Formatter` per format, which is created on the first call.
+
     Args:
         fmt (str): A date/time format defined in :func:`format`.
         simplified (bool): See :func:`format`.
@@ -86,6 +111,259 @@ def now(fmt = "dt", simplified = True):
         now = miscset.dt.now()
         print(now)
     """
-    dt = datetime.datetime.now()
-    return format(dt, fmt, simplified)
+    formatter = _formatters.get((fmt, simplified))
+    if formatter is None:
+        if len(_formatters) >= 64:
+            _formatters.clear()
+        formatter = _formatters[(fmt, simplified)] = Formatter(fmt, simplified)
+    return formatter.now()
+
+
+# strftime directives, which change at most once a day
+_DATE_DIRECTIVES = set("aAbBdjmUwWyYGuVh")
+# time directives rendered from integers, and their datetime attributes
+_TIME_DIRECTIVES = {"H": "hour", "M": "minute", "S": "second", "f": "microsecond"}
+
+
+class Formatter(object):
+    """A precompiled date/time format.
+
+    Formatting many datetimes or the current time repeatedly is faster
+    than with :func:`format` or :func:`now`: the date fields of the format are
+    rendered once per day, the hour, minute, second and microsecond fields
+    are filled in as numbers, and :meth:`now` reuses the result
+    within the same second.
+    Formats with other time directives (e.g. `%p` or `%z`) are rendered
+    with :py:meth:`datetime.datetime.strftime` once per second.
+
+    Args:
+        fmt (str): A date/time format defined in :func:`format`.
+        simplified (bool): See :func:`format`.
+        clock (callable): A function returning the current time as seconds
+            since the epoch. If given `None`, use :py:func:`time.time`.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        formatter = miscset.dt.Formatter("f", clock = lambda: 0)
+        print(formatter.now())
+        print(formatter())
+    """
+
+    def __init__(self, fmt = "dt", simplified = True, clock = None):
+        if simplified:
+            fmt = FORMATS.get(fmt.lower(), "")
+        self.fmt = fmt
+        self.clock = time.time if clock is None else clock
+        self._subsecond = "%f" in fmt
+        self._day = (None, None)
+        self._second = (None, None)
+        self._compile()
+
+    def _compile(self):
+        # a strftime pattern rendering the date fields, and leaving
+        # %-placeholders for the time fields
+        pattern = []
+        attributes = []
+        for token in re.split("(%.)", self.fmt):
+            if len(token) == 2 and token[0] == "%":
+                code = token[1]
+                if code in _TIME_DIRECTIVES:
+                    pattern.append("%%06d" if code == "f" else "%%02d")
+                    attributes.append(_TIME_DIRECTIVES[code])
+                elif code in _DATE_DIRECTIVES:
+                    pattern.append(token)
+                elif code == "%":
+                    pattern.append("%%%%")
+                else:
+                    self._pattern = None
+                    return
+            elif "%" in token:
+                self._pattern = None
+                return
+            else:
+                pattern.append(token)
+        self._pattern = "".join(pattern)
+        if not attributes:
+            self._fields = lambda dt: ()
+        elif len(attributes) == 1:
+            getter = operator.attrgetter(attributes[0])
+            self._fields = lambda dt: (getter(dt),)
+        else:
+            self._fields = operator.attrgetter(*attributes)
+
+    def format(self, dt):
+        """Format a datetime object.
+
+        Args:
+            dt (datetime.datetime): A datetime object to format to a string.
+
+        Returns:
+            str: The datetime object converted to a string.
+        """
+        if self._pattern is None:
+            return dt.strftime(self.fmt)
+        day = dt.toordinal()
+        cached, template = self._day
+        if cached != day:
+            template = dt.strftime(self._pattern)
+            self._day = (day, template)
+        return template % self._fields(dt)
+
+    def now(self):
+        """Obtain the current time of the `clock` as string.
+
+        Returns:
+            str: The current time formatted as string.
+        """
+        t = self.clock()
+        second = int(t // 1)
+        cached, text = self._second
+        if cached == second and not self._subsecond:
+            return text
+        text = self.format(datetime.datetime.fromtimestamp(t))
+        self._second = (second, text)
+        return text
+
+    __call__ = now
+
+
+_formatters = {}
+
+
+def parse(text, fmt = "dt", simplified = True):
+    """Parse a string to a datetime object.
+
+    The counterpart of :func:`format`.
+    Strings in a simplified format are parsed by their fixed positions of
+    digits, which is much faster than :py:meth:`datetime.datetime.strptime`.
+    Unlike `strptime`, all fields need their leading zeros, as with :func:`parse_many`.
+    A time without date (format "t") gets the date 1900-01-01, as with `strptime`.
+
+    Args:
+        text (str): A date/time string.
+        fmt (str): A date/time format defined in :func:`format`.
+        simplified (bool): See :func:`format`.
+
+    Returns:
+        datetime.datetime: The parsed date and time.
+
+    Raises:
+        ValueError: If `text` does not match the format.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        print(repr(miscset.dt.parse("2021-09-30_12-00-59", "f")))
+    """
+    if not simplified:
+        return datetime.datetime.strptime(text, fmt)
+    fmt = fmt.lower()
+    layout = _LAYOUTS.get(fmt)
+    if layout is None:
+        raise ValueError(f"unknown simplified format '{fmt}'")
+    if len(text) != layout[0] or _PATTERNS[fmt].fullmatch(text) is None:
+        # strptime would accept missing zero padding, as parse_many does not
+        raise ValueError(f"time data '{text}' does not match format '{fmt}'")
+    try:
+        if fmt == "t":
+            return datetime.datetime(1900, 1, 1, int(text[0:2]), int(text[3:5]), int(text[6:8]))
+        if fmt == "d":
+            return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]))
+        if fmt == "n":
+            return datetime.datetime(int(text[0:4]), int(text[4:6]), int(text[6:8]),
+                int(text[8:10]), int(text[10:12]), int(text[12:14]))
+        return datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]),
+            int(text[11:13]), int(text[14:16]), int(text[17:19]))
+    except ValueError:
+        # report errors as strptime does
+        return datetime.datetime.strptime(text, FORMATS[fmt])
+
+
+def parse_many(texts, fmt = "dt", simplified = True):
+    """Parse many strings to an array of datetimes.
 
+    A vectorized version of :func:`parse`. Strings in a simplified format
+    are decoded as a matrix of ASCII digits with :py:mod:`numpy`,
+    without creating a python object per string.
+
+    Args:
+        texts (list): Date/time strings, or a numpy array of strings.
+        fmt (str): A date/time format defined in :func:`format`.
+        simplified (bool): See :func:`format`.
+
+    Returns:
+        numpy.ndarray: An array of type `datetime64[s]`.
+
+    Raises:
+        ValueError: If any string does not match the format.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        print(miscset.dt.parse_many(["20210930120059", "20211231235959"], "n"))
+    """
+    if not simplified:
+        return numpy.array([datetime.datetime.strptime(t, fmt) for t in texts],
+            dtype = "datetime64[s]")
+    fmt = fmt.lower()
+    layout = _LAYOUTS.get(fmt)
+    if layout is None:
+        raise ValueError(f"unknown simplified format '{fmt}'")
+    width, fields, separators = layout
+    texts = numpy.asarray(texts)
+    if texts.dtype.kind not in "US":
+        # object arrays, pandas series of str, ...
+        texts = texts.astype(str)
+    texts = numpy.ascontiguousarray(texts)
+    if texts.size == 0:
+        return numpy.array([], dtype = "datetime64[s]").reshape(texts.shape)
+    # view strings as a matrix of character codes, shorter strings are padded with zeros
+    if texts.dtype.kind == "U" and texts.dtype.itemsize == 4 * width:
+        chars = texts.reshape(-1).view(numpy.uint32).reshape(-1, width)
+    elif texts.dtype.kind == "S" and texts.dtype.itemsize == width:
+        chars = texts.reshape(-1).view(numpy.uint8).reshape(-1, width)
+    else:
+        raise ValueError(f"time data does not match format '{fmt}'")
+    digits = chars.astype(numpy.int64) - ord("0")
+    valid = numpy.ones(len(chars), dtype = bool)
+    positions = numpy.ones(width, dtype = bool)
+    for i, c in separators.items():
+        valid &= chars[:, i] == ord(c)
+        positions[i] = False
+    valid &= numpy.all((digits[:, positions] >= 0) & (digits[:, positions] <= 9), axis = 1)
+    def field(name, size = 2):
+        if name not in fields:
+            return None
+        i = fields[name]
+        value = digits[:, i]
+        for j in range(i + 1, i + size):
+            value = value * 10 + digits[:, j]
+        return value
+    year, month, day = field("Y", 4), field("m"), field("d")
+    hour, minute, second = field("H"), field("M"), field("S")
+    if year is None:
+        days = numpy.full(len(chars), numpy.datetime64("1900-01-01", "D"))
+    else:
+        valid &= (year >= 1) & (month >= 1) & (month <= 12) & (day >= 1)
+        months = (year - 1970) * 12 + month - 1
+        months = months.astype("timedelta64[M]") + numpy.datetime64("1970-01", "M")
+        days = months.astype("datetime64[D]") + (day - 1).astype("timedelta64[D]")
+        # a day exceeding the month length shifts the month
+        valid &= days.astype("datetime64[M]") == months
+    result = days.astype("datetime64[s]")
+    if hour is not None:
+        valid &= (hour <= 23) & (minute <= 59) & (second <= 59)
+        result = result + (hour * 3600 + minute * 60 + second).astype("timedelta64[s]")
+    if not numpy.all(valid):
+        bad = texts.reshape(-1)[~valid][0]
+        if isinstance(bad, bytes):
+            bad = bad.decode("ascii", "replace")
+        raise ValueError(f"time data '{bad}' does not match format '{fmt}'")
+    return result.reshape(texts.shape)
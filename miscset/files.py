@@ -1,10 +1,57 @@
-"""Methods to work on file systems."""
+"""Methods to work on file systems.
+
+Search folders for files and directories with :func:`find`,
+or follow changes to such files as they happen with :func:`watch`.
+"""
 
 
 import os
 import re
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+from . import metrics
+
+
+logger = logging.getLogger()
+
+
+def _compile_regex(regex, case):
+    if regex is None:
+        return None
+    return re.compile(regex, re.IGNORECASE if case else 0)
+
+
+def _clean_extensions(extensions):
+    if extensions is None:
+        return None
+    tmp = []
+    for e in extensions:
+        e = str(e).lower()
+        if not e.startswith("."):
+            e = f".{e}"
+        tmp.append(e)
+    return tmp
 
 
+def _match_extensions(name, extensions):
+    if extensions is None:
+        return True
+    ext = os.path.splitext(name)[1]
+    return ext in extensions
+
+
+def _match_regex(name, regex):
+    if regex is None:
+        return True
+    return regex.search(name)
+
+
+@metrics.timed("files.find")
 def find(path = ".", recurse = True, type = None, regex = None, extensions = None,
     absolute = False, case = True):
     """Get list of paths to files in a folder.
@@ -28,32 +75,10 @@ def find(path = ".", recurse = True, type = None, regex = None, extensions = Non
     if type is None:
         type = "df"
     names = []
-    if case:
-        case = re.IGNORECASE
-    else:
-        case = 0
-    if regex is not None:
-        regex = re.compile(regex, case)
-    # cleanup extensions
-    if extensions is not None:
-        tmp = []
-        for e in extensions:
-            e = str(e).lower()
-            if not e.startswith("."):
-                e = f".{e}"
-            tmp.append(e)
-        extensions = tmp
+    regex = _compile_regex(regex, case)
+    extensions = _clean_extensions(extensions)
 
     # helper
-    def match_extensions(name, extensions):
-        if extensions is None:
-            return True
-        ext = os.path.splitext(name)[1]
-        return ext in extensions
-    def match_regex(name, regex):
-        if regex is None:
-            return True
-        return regex.search(name)
     def abs(name):
         return os.path.abspath(name)
 
@@ -64,10 +89,11 @@ def find(path = ".", recurse = True, type = None, regex = None, extensions = Non
         if not recurse and level > 0:
             break
         level += 1
+        metrics.add("files.find.entries", len(dnames) + len(fnames))
         # collect directories
         if "d" in type:
             for name in dnames:
-                if not match_regex(name, regex):
+                if not _match_regex(name, regex):
                     continue
                 name = os.path.join(root, name)
                 if absolute:
@@ -76,9 +102,9 @@ def find(path = ".", recurse = True, type = None, regex = None, extensions = Non
         # collect files
         if "f" in type:
             for name in fnames:
-                if not match_extensions(name, extensions):
+                if not _match_extensions(name, extensions):
                     continue
-                if not match_regex(name, regex):
+                if not _match_regex(name, regex):
                     continue
                 name = os.path.join(root, name)
                 if absolute:
@@ -86,3 +112,364 @@ def find(path = ".", recurse = True, type = None, regex = None, extensions = Non
                 names.append(name)
     return names
 
+
+
+### watch
+
+
+_IN_MODIFY      = 0x00000002
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_IGNORED     = 0x00008000
+_IN_ISDIR       = 0x40000000
+_IN_MASK = (_IN_MODIFY | _IN_MOVED_FROM | _IN_MOVED_TO |
+    _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF)
+_IN_EVENT = struct.Struct("iIII")
+
+
+def _libc():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    except OSError:
+        return None
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+class _Inotify:
+    """Read file events from the linux kernel inotify interface."""
+
+    def __init__(self, path, recurse, match, strict = False):
+        self.libc = _libc()
+        self.path = path
+        self.recurse = recurse
+        self.match = match
+        self.strict = strict
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        # watched folders by watch descriptor, and matching file names per folder
+        self.dirs = {}
+        self.files = {}
+        self.since = time.time_ns()
+        try:
+            self.add(path)
+        except OSError:
+            self.close()
+            raise
+
+    def add(self, path, scan = False):
+        """Watch a directory (recursively) and return files found on `scan`.
+
+        A folder which cannot be watched (e.g. if the limit of watches is reached)
+        raises an :py:class:`OSError` if `strict`, otherwise a warning is logged.
+        """
+        events = []
+        for root, dnames, fnames in os.walk(path):
+            names = {name for name in fnames if self.match(name)}
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), _IN_MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if self.strict:
+                    raise OSError(errno, "cannot watch folder {}".format(root))
+                logger.warning("cannot watch folder %s: %s", root, os.strerror(errno))
+            else:
+                self.dirs[wd] = root
+                self.files[root] = names
+            if scan:
+                events += [("created", os.path.join(root, name)) for name in sorted(names)]
+            if not self.recurse:
+                break
+        return events
+
+    def remove(self, path):
+        """Stop watching a directory (recursively) and return its files as deleted."""
+        prefix = os.path.join(path, "")
+        def below(root):
+            return root == path or root.startswith(prefix)
+        for wd, root in list(self.dirs.items()):
+            if below(root):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+        events = []
+        for root in [root for root in self.files if below(root)]:
+            events += [("deleted", os.path.join(root, name))
+                for name in sorted(self.files.pop(root))]
+        return events
+
+    def rescan(self):
+        """Watch the folder again after events were lost and return the changes."""
+        def known():
+            return {os.path.join(root, name)
+                for root, names in self.files.items() for name in names}
+        old = known()
+        dirs = self.dirs
+        self.dirs = {}
+        self.files = {}
+        self.add(self.path)
+        for wd in dirs.keys() - self.dirs.keys():
+            self.libc.inotify_rm_watch(self.fd, wd)
+        new = known()
+        events = [("created", path) for path in sorted(new - old)]
+        for path in sorted(new & old):
+            try:
+                if os.stat(path).st_mtime_ns >= self.since:
+                    events.append(("modified", path))
+            except OSError:
+                continue
+        events += [("deleted", path) for path in sorted(old - new)]
+        return events
+
+    def read(self, timeout):
+        """Wait up to `timeout` seconds for matching events and return them."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = None if deadline is None else max(0, deadline - time.monotonic())
+            ready, _, _ = select.select([self.fd], [], [], wait)
+            if ready:
+                events = self.parse()
+                if events:
+                    return events
+            if deadline is not None and time.monotonic() >= deadline:
+                return []
+
+    def parse(self):
+        """Read the queued events and return those of matching files."""
+        since = time.time_ns()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, size = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = os.fsdecode(data[offset:offset + size].rstrip(b"\0"))
+            offset += size
+            if mask & _IN_Q_OVERFLOW:
+                logger.warning("inotify event queue overflow, rescanning %s", self.path)
+                events += self.rescan()
+                continue
+            root = self.dirs.get(wd)
+            if root is None:
+                continue
+            if mask & (_IN_IGNORED | _IN_DELETE_SELF):
+                del self.dirs[wd]
+                self.files.pop(root, None)
+                continue
+            path = os.path.join(root, name)
+            if mask & _IN_ISDIR:
+                if self.recurse and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    events += self.add(path, scan = True)
+                elif mask & _IN_MOVED_FROM:
+                    # a folder moved out of the tree reports no events for its files
+                    events += self.remove(path)
+                continue
+            if not self.match(name):
+                continue
+            names = self.files.setdefault(root, set())
+            if mask & (_IN_CREATE | _IN_MOVED_TO):
+                names.add(name)
+                events.append(("created", path))
+            elif mask & (_IN_DELETE | _IN_MOVED_FROM):
+                names.discard(name)
+                events.append(("deleted", path))
+            elif mask & _IN_MODIFY:
+                events.append(("modified", path))
+        self.since = since
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Poller:
+    """Compare snapshots of file modification times and sizes."""
+
+    def __init__(self, path, recurse, match, interval):
+        self.path = path
+        self.recurse = recurse
+        self.match = match
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        stack = [self.path]
+        while stack:
+            root = stack.pop()
+            try:
+                entries = list(os.scandir(root))
+            except OSError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks = False):
+                        if self.recurse:
+                            stack.append(entry.path)
+                    elif self.match(entry.name):
+                        stat = entry.stat()
+                        snapshot[entry.path] = (stat.st_mtime_ns, stat.st_size)
+                except OSError:
+                    continue
+        return snapshot
+
+    def diff(self):
+        old = self.snapshot
+        new = self.scan()
+        self.snapshot = new
+        events = []
+        for path, stat in new.items():
+            if path not in old:
+                events.append(("created", path))
+            elif old[path] != stat:
+                events.append(("modified", path))
+        events += [("deleted", path) for path in old if path not in new]
+        return events
+
+    def read(self, timeout):
+        """Poll up to `timeout` seconds for changes and return them."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            events = self.diff()
+            if events:
+                return events
+            wait = self.interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return []
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def close(self):
+        self.snapshot = {}
+
+
+def _coalesce(pending, events):
+    # merge subsequent events of the same path into a single net change
+    for event, path in events:
+        last = pending.get(path)
+        if last is None:
+            pending[path] = event
+        elif last == "created":
+            if event == "deleted":
+                del pending[path]
+        elif last == "deleted":
+            if event != "deleted":
+                pending[path] = "modified"
+        elif event == "deleted":
+            pending[path] = "deleted"
+    return pending
+
+
+def watch(path = ".", recurse = True, regex = None, extensions = None,
+    absolute = False, case = True, backend = None, interval = 1.0,
+    debounce = 0.1, max_delay = 1.0, timeout = None):
+    """Follow changes to files in a folder.
+
+    Yield batches of file events as they happen below `path`, instead
+    of repeatedly calling :func:`find` and comparing the results.
+    On Linux the kernel inotify interface is used, so that no work is done
+    while nothing changes. Otherwise the folder is polled by comparing
+    snapshots of file modification times and sizes every `interval` seconds.
+
+    Events following each other within `debounce` seconds are collected in
+    one batch, and multiple events on the same path are merged into the net
+    change, e.g. a file created and then written to is reported as
+    created once. A batch is reported at the latest `max_delay` seconds
+    after its first event, also while files keep changing.
+
+    Args:
+        path (str): Path to a folder on a filesystem.
+        recurse (bool): Watch sub folders as well.
+        regex (str): Report only files whose name matches this regular expression.
+        extensions (list): Report only files with one of these extensions.
+        absolute (bool): Report absolute paths.
+        case (bool): Match `regex` ignoring case, as in :func:`find`.
+        backend (str): One of 'inotify' or 'poll'. If given `None`,
+            use 'inotify' where available, otherwise 'poll', also when
+            inotify fails, e.g. if the limit of watched folders is reached.
+        interval (float): Seconds between two scans of the 'poll' backend.
+        debounce (float): Seconds to wait for further events before a batch is reported.
+        max_delay (float): Maximum seconds to collect events for a batch.
+            If given `None`, collect until no event follows within `debounce`.
+        timeout (float): Seconds to wait for any event before the generator stops.
+            If given `None`, wait forever.
+
+    Yields:
+        list: A batch of tuples `(event, path)`, where `event` is one of
+            'created', 'modified' or 'deleted'.
+
+    .. code-block:: python
+
+        import miscset
+        for batch in miscset.files.watch("data", extensions = ["csv"]):
+            for event, path in batch:
+                print(event, path)
+    """
+    path = os.path.expanduser(path)
+    regex = _compile_regex(regex, case)
+    extensions = _clean_extensions(extensions)
+    def match(name):
+        return _match_extensions(name, extensions) and _match_regex(name, regex)
+    auto = backend is None
+    if auto:
+        backend = "inotify" if _libc() is not None else "poll"
+    watcher = None
+    if backend == "inotify":
+        try:
+            watcher = _Inotify(path, recurse, match, strict = auto)
+        except OSError as e:
+            if not auto:
+                raise
+            logger.warning("cannot use inotify (%s), polling %s instead", e, path)
+    elif backend != "poll":
+        raise Exception("There is no such backend")
+    if watcher is None:
+        watcher = _Poller(path, recurse, match, interval)
+    def read(wait):
+        nonlocal watcher
+        try:
+            return watcher.read(wait)
+        except OSError as e:
+            if not auto:
+                raise
+            logger.warning("cannot use inotify (%s), polling %s instead", e, path)
+            watcher.close()
+            watcher = _Poller(path, recurse, match, interval)
+            return watcher.read(wait)
+    try:
+        while True:
+            events = read(timeout)
+            if not events:
+                if timeout is not None:
+                    return
+                continue
+            pending = _coalesce({}, events)
+            deadline = None if max_delay is None else time.monotonic() + max_delay
+            while events:
+                wait = debounce
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        break
+                events = read(wait)
+                _coalesce(pending, events)
+            batch = []
+            for name, event in pending.items():
+                if absolute:
+                    name = os.path.abspath(name)
+                batch.append((event, name))
+            if batch:
+                yield batch
+    finally:
+        watcher.close()
@@ -10,73 +10,182 @@ or reading from
 - **text files** as lines
 - **yaml** or **json** files as dictionaries
 - **csv** files as array
+- **tiff** files as array, also many files as one lazy array
 
 or parsing data (dictionary, json/yaml) to and from a ``Parsable`` class object made easy!
+
+Text files are written atomically, i.e. readers never see a partially written file.
+Files ending with ``.gz``, ``.zst`` or ``.lz4`` are (de)compressed transparently
+(``.zst`` requires the `zstandard` and ``.lz4`` the `lz4` package).
 """
 
 
 import os
+import re
 import sys
+import gzip
 import json
+import mmap
+import stat
+import uuid
+import pickle
+import functools
+import itertools
+import threading
+import contextlib
+import collections
+import concurrent.futures
 import yaml
+import numpy
 import pandas
 import exifread
 import tifffile
 import logging
+from . import metrics
 
 
 logger = logging.getLogger()
 """A logger enabled by the logging module."""
 
 
+### files
+
+
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd", ".lz4": "lz4"}
+"""File extensions mapped to the compression used for such files."""
+
+
+def _open(path, mode = "r", buffering = -1, encoding = None, errors = None,
+    newline = None, compression = "infer"):
+    # open a file like `open`, with transparent (de)compression
+    compression = _compression(path, compression)
+    if compression is None:
+        return open(path, mode, buffering, encoding, errors, newline)
+    if "b" not in mode and "t" not in mode:
+        mode += "t"
+    kwargs = {}
+    if "t" in mode:
+        kwargs = dict(encoding = encoding, errors = errors, newline = newline)
+    if compression == "gzip":
+        return gzip.open(path, mode, **kwargs)
+    elif compression == "zstd":
+        import zstandard
+        return zstandard.open(path, mode, **kwargs)
+    elif compression == "lz4":
+        import lz4.frame
+        return lz4.frame.open(path, mode, **kwargs)
+    else:
+        raise Exception("There is no such compression")
+
+
+def _compression(path, compression):
+    # resolve the compression from the target path, not a temporary file
+    if compression == "infer":
+        compression = COMPRESSIONS.get(os.path.splitext(str(path))[1].lower())
+    return compression
+
+
+@contextlib.contextmanager
+def _atomic(path, fsync = False):
+    # yield a temporary path next to `path`, which replaces `path` on success;
+    # symbolic links are followed, so that the link target is replaced
+    path = os.path.realpath(path)
+    folder = os.path.dirname(path)
+    tmp = os.path.join(folder, ".{}.{}.tmp".format(os.path.basename(path), uuid.uuid4().hex))
+    # create the file as `open` would, with permissions respecting the umask
+    os.close(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666))
+    try:
+        yield tmp
+        # keep the permissions and owner of an existing file, as `open` would
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        if st is not None:
+            os.chmod(tmp, stat.S_IMODE(st.st_mode))
+            with contextlib.suppress(OSError, AttributeError):
+                os.chown(tmp, st.st_uid, st.st_gid)
+        if fsync:
+            fd = os.open(tmp, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp)
+        raise
+    if fsync:
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
 ### input
 
 
+def _file_size(path, *args, **kwargs):
+    # bytes read by a reader, recorded in the metrics
+    return os.path.getsize(path)
+
+
+@metrics.timed("io.read_txt", _file_size)
 def read_txt(path, *args, **kwargs):
     """Read text as string from a file.
     
+    Compressed files are decompressed transparently (see :py:mod:`miscset.io`).
+
     Args:
         path (str): A path to a file.
         args, kwargs: Any other argument passed to `open`,
-            such as mode, encoding, etc.
+            such as mode, encoding, etc., and `compression`,
+            one of 'gzip', 'zstd', 'lz4', `None` for none,
+            or 'infer' (default) to choose by file extension.
 
     Returns:
         str: The text (or bytestring, depending on the mode selected)
             from the selected file.
     """
-    fs = open(path, *args, **kwargs)
-    text = fs.read()
-    fs.close()
+    with _open(path, *args, **kwargs) as fs:
+        text = fs.read()
     return text
 
 
+@metrics.timed("io.read_lines", _file_size)
 def read_lines(path, strip = os.linesep, *args, **kwargs):
     """Read text as lines from a file.
 
     A file is read line by line and parsed as a list of strings.
+    Compressed files are decompressed while reading.
 
     Args:
         path (str): File path.
         strip (str): Characters to strip from the end
             of each line. `None` to skip stripping.
         args, kwargs: Any other argument passed to `open`,
-            such as mode, encoding, etc.
+            such as mode, encoding, etc., and `compression`
+            (see :func:`read_txt`).
 
     Returns:
         list: Lines read from the file as a list of strings.
     """
-    fs = open(path, *args, **kwargs)
-    lines = fs.readlines()
-    fs.close()
-    if strip is not None:
-        lines = [line.rstrip(strip) for line in lines]
+    with _open(path, *args, **kwargs) as fs:
+        if strip is None:
+            lines = list(fs)
+        else:
+            lines = [line.rstrip(strip) for line in fs]
     return lines
 
 
+@metrics.timed("io.read_json", _file_size)
 def read_json(path):
     """Read a JSON file.
 
     Read a JSON formatted file into a dictionary object.
+    Compressed files are decompressed while reading.
 
     Args:
         path (str): File path to JSON formatted file.
@@ -84,12 +193,12 @@ def read_json(path):
     Returns:
         dict: Content of a JSON file parsed as dictionary.
     """
-    fs = open(path, "r")
-    d = json.load(fs)
-    fs.close()
+    with _open(path, "r") as fs:
+        d = json.load(fs)
     return d
 
 
+@metrics.timed("io.read_yaml", _file_size)
 def read_yaml(path):
     """Read a YAML file.
 
@@ -111,18 +220,19 @@ def read_yaml(path):
     """
     d = {}
     if not os.path.isfile(path):
-        logging.error("missing YAML file at {}".format(path))
+        logging.error("missing YAML file at %s", path)
         return d
-    with open(path, "r") as fs:
+    with _open(path, "r") as fs:
         try:
-            logging.info("parsing YAML from file {}".format(path))
+            logging.info("parsing YAML from file %s", path)
             d = yaml.safe_load(fs)
         except yaml.YAMLError as e:
-            logging.error("failed importing {} YAML {}".format(path, e))
-    logging.debug("parsed YAML content as {}".format(d))
+            logging.error("failed importing %s YAML %s", path, e)
+    logging.debug("parsed YAML content as %s", d)
     return d
 
 
+@metrics.timed("io.read_csv", _file_size)
 def read_csv(path, *args, **kwargs):
     """Read a CSV file.
 
@@ -139,6 +249,7 @@ def read_csv(path, *args, **kwargs):
     return csv
 
 
+@metrics.timed("io.read_xl", _file_size)
 def read_xl(path, *args, **kwargs):
     """Read an EXCEL table.
 
@@ -155,6 +266,7 @@ def read_xl(path, *args, **kwargs):
     return xl
 
 
+@metrics.timed("io.read_tiff", _file_size)
 def read_tiff(path):
     """Read TIFF image using tifffile.
     
@@ -193,22 +305,917 @@ def read_tiff_tags(path, parser = "tifffile", prefix = False):
         raise Exception("There is no such parser")
 
 
+### load
+
+
+FORMATS = {
+    ".json": "json",
+    ".yml": "yaml",
+    ".yaml": "yaml",
+    ".csv": "csv",
+    ".xls": "excel",
+    ".xlsx": "excel",
+    ".xlsm": "excel",
+    ".tif": "tiff",
+    ".tiff": "tiff",
+    ".txt": "text",
+}
+"""File extensions mapped to the formats known by :func:`load`."""
+
+
+_MAGIC = [
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"II+\x00", "tiff"),
+    (b"MM\x00+", "tiff"),
+    (b"PK\x03\x04", "excel"),
+    (b"\xd0\xcf\x11\xe0", "excel"),
+]
+
+
+def sniff(path):
+    """Guess the format of a file.
+
+    The format is chosen by the file extension (ignoring a compression
+    extension, see :py:mod:`miscset.io`), or else by the first bytes
+    of the file content.
+
+    Args:
+        path (str): File path.
+
+    Returns:
+        str: One of the formats supported by :func:`load`,
+            i.e. 'json', 'yaml', 'csv', 'excel', 'tiff' or 'text'.
+    """
+    name, ext = os.path.splitext(str(path).lower())
+    if ext in COMPRESSIONS:
+        ext = os.path.splitext(name)[1]
+    if ext in FORMATS:
+        return FORMATS[ext]
+    with _open(path, "rb") as fs:
+        head = fs.read(64)
+    for magic, fmt in _MAGIC:
+        if head.startswith(magic):
+            return fmt
+    head = head.lstrip()
+    if head[:1] in (b"{", b"["):
+        return "json"
+    if head.startswith(b"---") or head.startswith(b"%YAML"):
+        return "yaml"
+    return "text"
+
+
+def _sizeof(obj, seen = None):
+    # estimate the memory used by a parsed object
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, pandas.DataFrame):
+        return int(obj.memory_usage(deep = True).sum())
+    if hasattr(obj, "nbytes"):
+        return int(obj.nbytes)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(_sizeof(v, seen) for v in obj)
+    return size
+
+
+class LoadCache(object):
+    """A cache of parsed files used by :func:`load`.
+
+    Entries are identified by the file path, size and modification time,
+    so that a changed file is parsed again.
+    The least recently used entries are removed when the estimated memory
+    of all entries exceeds `max_bytes`, or, if a `spill` folder is given,
+    pickled to that folder and loaded from there when requested again.
+
+    Args:
+        max_bytes (int): Memory limit for cached objects.
+        spill (str): A folder to store entries removed from memory.
+            If given `None`, entries are discarded.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        miscset.io.load("tests/example.yml")
+        miscset.io.load("tests/example.yml")
+        print(miscset.io.load_cache.stats())
+    """
+
+    def __init__(self, max_bytes = 256 * 2**20, spill = None):
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self._lock = threading.RLock()
+        self._spilled = {}
+        self.clear()
+
+    def clear(self):
+        """Remove all entries, including spilled files."""
+        with self._lock:
+            for fname in self._spilled.values():
+                with contextlib.suppress(OSError):
+                    os.unlink(fname)
+            self._entries = collections.OrderedDict()
+            self._spilled = {}
+            self._keys = {}
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return the number of entries, bytes, hits and misses as dictionary."""
+        with self._lock:
+            return {"entries": len(self._entries), "spilled": len(self._spilled),
+                "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+    def get(self, key, default = None):
+        """Return the object cached for `key`, or `default`."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key][0]
+            fname = self._spilled.pop(key, None)
+            if fname is not None:
+                with open(fname, "rb") as fs:
+                    obj = pickle.load(fs)
+                os.unlink(fname)
+                self.hits += 1
+                self._store(key, obj)
+                return obj
+            self.misses += 1
+            return default
+
+    def put(self, key, obj):
+        """Cache an object for `key`, replacing entries of outdated files.
+
+        The `key` is a tuple, where the first item identifies the file and
+        the remaining items its state, such as the size and modification time.
+        """
+        with self._lock:
+            old = self._keys.get(key[0])
+            if old is not None and old != key:
+                self._discard(old)
+            self._discard(key)
+            self._keys[key[0]] = key
+            self._store(key, obj)
+
+    def _discard(self, key):
+        if self._keys.get(key[0]) == key:
+            del self._keys[key[0]]
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+        fname = self._spilled.pop(key, None)
+        if fname is not None:
+            with contextlib.suppress(OSError):
+                os.unlink(fname)
+
+    def _store(self, key, obj):
+        size = _sizeof(obj)
+        self._entries[key] = (obj, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self._entries) > 1:
+            old, (value, size) = self._entries.popitem(last = False)
+            self.bytes -= size
+            if self.spill is not None:
+                os.makedirs(self.spill, exist_ok = True)
+                fname = os.path.join(self.spill, uuid.uuid4().hex + ".pkl")
+                with open(fname, "wb") as fs:
+                    pickle.dump(value, fs, protocol = pickle.HIGHEST_PROTOCOL)
+                self._spilled[old] = fname
+            elif self._keys.get(old[0]) == old:
+                del self._keys[old[0]]
+
+
+load_cache = LoadCache()
+"""The process wide :class:`LoadCache` used by :func:`load`."""
+
+
+# marks a cache miss, as files may parse to `None`
+_MISSING = object()
+
+
+LOADERS = {
+    "json": read_json,
+    "yaml": read_yaml,
+    "csv": read_csv,
+    "excel": read_xl,
+    "tiff": read_tiff,
+    "text": read_txt,
+}
+"""Formats mapped to the functions reading them, used by :func:`load`."""
+
+
+@metrics.timed("io.load", _file_size)
+def load(path, format = None, cache = True, **kwargs):
+    """Read a file of any supported format.
+
+    Detect the format of a file (see :func:`sniff`) and parse it
+    with the matching reader from :py:data:`LOADERS`.
+    Parsed objects are kept in the :py:data:`load_cache`, so that
+    loading an unchanged file again returns the cached object.
+    Cached objects are shared between calls, do not modify them in place.
+
+    Args:
+        path (str): File path.
+        format (str): Skip detection and use one of the formats from :py:data:`LOADERS`.
+        cache (bool): Use the :py:data:`load_cache`.
+        kwargs: Arguments passed to the reader.
+
+    Returns:
+        The parsed file content, e.g. a dict, DataFrame or array.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        print(miscset.io.load("tests/example.json"))
+    """
+    if format is None:
+        format = sniff(path)
+    if format not in LOADERS:
+        raise Exception("There is no such format")
+    if not cache:
+        return LOADERS[format](path, **kwargs)
+    st = os.stat(path)
+    key = ((os.path.abspath(path), format, repr(sorted(kwargs.items()))),
+        st.st_size, st.st_mtime_ns)
+    obj = load_cache.get(key, _MISSING)
+    if obj is _MISSING:
+        obj = LOADERS[format](path, **kwargs)
+        load_cache.put(key, obj)
+    return obj
+
+
+def _read_one(reader, path, kwargs):
+    return reader(path, **kwargs)
+
+
+def iread_many(paths, reader = None, workers = None, executor = "thread",
+    ordered = True, **kwargs):
+    """Read many files concurrently.
+
+    Files are read by a pool of `workers`, while only a limited
+    number of results (twice the number of workers) is held back,
+    so that memory stays bounded also for long lists of files.
+
+    Args:
+        paths (list): File paths, e.g. from :func:`miscset.files.find`.
+        reader (callable or str): A function reading a file, or a format from
+            :py:data:`LOADERS`. If given `None`, use :func:`load` without the
+            :py:data:`load_cache`, pass ``reader = miscset.io.load`` to fill it.
+        workers (int): Number of threads or processes.
+            If given `None`, use the number of CPUs.
+        executor (str): One of 'thread' or 'process'. Processes require
+            a `reader` that can be pickled.
+        ordered (bool): Yield results in the order of `paths`,
+            otherwise as soon as they are available.
+        kwargs: Arguments passed to the reader.
+
+    Yields:
+        tuple: The path and the object read from it.
+    """
+    if reader is None:
+        # a single pass over many files would only evict useful cache entries
+        reader = functools.partial(load, cache = False)
+    elif isinstance(reader, str):
+        reader = LOADERS[reader]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if executor == "thread":
+        pool = concurrent.futures.ThreadPoolExecutor(workers)
+    elif executor == "process":
+        pool = concurrent.futures.ProcessPoolExecutor(workers)
+    else:
+        raise Exception("There is no such executor")
+    paths = iter(paths)
+    pending = collections.OrderedDict()
+    def submit():
+        for path in itertools.islice(paths, 2 * workers - len(pending)):
+            pending[pool.submit(_read_one, reader, path, kwargs)] = path
+    with pool:
+        try:
+            submit()
+            while pending:
+                if ordered:
+                    future = next(iter(pending))
+                else:
+                    done = concurrent.futures.wait(pending,
+                        return_when = concurrent.futures.FIRST_COMPLETED)[0]
+                    future = next(f for f in pending if f in done)
+                path = pending.pop(future)
+                result = future.result()
+                submit()
+                yield path, result
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def read_many(paths, reader = None, workers = None, executor = "thread",
+    ordered = True, concat = False, source = "source", **kwargs):
+    """Read many files concurrently.
+
+    See :func:`iread_many` for the arguments `paths`, `reader`, `workers`,
+    `executor`, `ordered` and `kwargs`.
+
+    Args:
+        concat (bool): Combine tables (DataFrames) to a single table,
+            which is created at once, after all files are read.
+        source (str): Name of a column added to the combined table,
+            holding the path of the file each row was read from.
+            If given `None`, skip adding it.
+
+    Returns:
+        list or DataFrame: The objects read, or the combined table if `concat` is set.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        paths = miscset.files.find("tests", extensions = ["json", "yml"])
+        print(miscset.io.read_many(sorted(paths)))
+    """
+    results = iread_many(paths, reader, workers, executor, ordered, **kwargs)
+    if not concat:
+        return [obj for path, obj in results]
+    frames = []
+    for path, df in results:
+        if source is not None:
+            df = df.assign(**{source: path})
+        frames.append(df)
+    if not frames:
+        return pandas.DataFrame()
+    return pandas.concat(frames, ignore_index = True)
+
+
+### keys
+
+
+_KEY_STEP = re.compile(r"""\.?([^.\[\]'"]+)|\[(-?\d+)\]|\[(['"])(.*?)\3\]""")
+
+
+def _parse_keys(keys):
+    # split a key path like "a.b[3].c" or "$.a['b.c']" into steps
+    if keys.startswith("$"):
+        keys = keys[1:]
+    steps = []
+    pos = 0
+    while pos < len(keys):
+        m = _KEY_STEP.match(keys, pos)
+        if m is None:
+            raise ValueError("invalid key path '{}'".format(keys))
+        if m.group(1) is not None:
+            steps.append(m.group(1))
+        elif m.group(2) is not None:
+            step = int(m.group(2))
+            if step < 0:
+                raise ValueError("negative list position in key path '{}'".format(keys))
+            steps.append(step)
+        else:
+            steps.append(m.group(4))
+        pos = m.end()
+    return steps
+
+
+def _format_keys(steps):
+    # the canonical key path of steps, used in the index
+    return "".join("[{}]".format(s) if isinstance(s, int) else "[{}]".format(json.dumps(s))
+        for s in steps)
+
+
+_JSON_SPACE = re.compile(rb"[ \t\n\r]*")
+_JSON_STRING = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+# anything but brackets, in bounded repeats to limit the memory used by the regex engine
+_JSON_FLAT = re.compile(rb'(?:[^\[\]{}"]+|"[^"\\]*(?:\\.[^"\\]*)*"){0,1024}', re.DOTALL)
+_JSON_SCALAR = re.compile(rb"[^,\]}\s]+")
+
+
+def _json_space(buf, pos):
+    return _JSON_SPACE.match(buf, pos).end()
+
+
+def _json_skip(buf, pos):
+    # return the end of the JSON value starting at pos, without parsing it
+    c = buf[pos:pos + 1]
+    if c == b'"':
+        return _JSON_STRING.match(buf, pos).end()
+    if c in (b"{", b"["):
+        depth = 0
+        while True:
+            c = buf[pos:pos + 1]
+            if c in (b"{", b"["):
+                depth += 1
+                pos += 1
+            elif c in (b"}", b"]"):
+                depth -= 1
+                pos += 1
+                if depth == 0:
+                    return pos
+            # skip anything but brackets, including strings holding brackets
+            end = _JSON_FLAT.match(buf, pos).end()
+            if end == pos and buf[pos:pos + 1] not in (b"{", b"[", b"}", b"]"):
+                raise ValueError("unexpected end of JSON document")
+            pos = end
+    m = _JSON_SCALAR.match(buf, pos)
+    if m is None:
+        raise ValueError("invalid JSON value at byte {}".format(pos))
+    return m.end()
+
+
+def _json_find(buf, pos, steps):
+    # return the start of the value at steps below the value starting at pos,
+    # and the starts of all values passed, or None if missing
+    starts = []
+    for step in steps:
+        pos = _json_space(buf, pos)
+        c = buf[pos:pos + 1]
+        if isinstance(step, int):
+            if c != b"[" or step < 0:
+                return None
+            pos = _json_space(buf, pos + 1)
+            if buf[pos:pos + 1] == b"]":
+                return None
+            for i in range(step):
+                pos = _json_space(buf, _json_skip(buf, pos))
+                if buf[pos:pos + 1] != b",":
+                    return None
+                pos = _json_space(buf, pos + 1)
+        else:
+            if c != b"{":
+                return None
+            pos += 1
+            while True:
+                pos = _json_space(buf, pos)
+                m = _JSON_STRING.match(buf, pos)
+                if m is None:
+                    return None
+                key = json.loads(m.group())
+                pos = _json_space(buf, m.end())
+                if buf[pos:pos + 1] != b":":
+                    raise ValueError("invalid JSON object at byte {}".format(pos))
+                pos = _json_space(buf, pos + 1)
+                if key == step:
+                    break
+                pos = _json_space(buf, _json_skip(buf, pos))
+                if buf[pos:pos + 1] != b",":
+                    return None
+                pos += 1
+        starts.append(pos)
+    return _json_space(buf, pos), starts
+
+
+def _read_json_keys(path, paths, index):
+    # values of key paths from a JSON file, and the updated index offsets
+    offsets = dict(index)
+    values = {}
+    with contextlib.ExitStack() as stack:
+        if _compression(path, "infer") is None:
+            fs = stack.enter_context(open(path, "rb"))
+            if os.fstat(fs.fileno()).st_size == 0:
+                raise ValueError("empty JSON document")
+            buf = stack.enter_context(mmap.mmap(fs.fileno(), 0, access = mmap.ACCESS_READ))
+        else:
+            with _open(path, "rb") as fs:
+                buf = fs.read()
+        for name, steps in paths.items():
+            # continue from the deepest value found in the index before
+            depth = len(steps)
+            while depth and _format_keys(steps[:depth]) not in offsets:
+                depth -= 1
+            pos = offsets[_format_keys(steps[:depth])] if depth else 0
+            found = _json_find(buf, pos, steps[depth:])
+            if found is None:
+                continue
+            pos, starts = found
+            for i, start in enumerate(starts):
+                offsets[_format_keys(steps[:depth + i + 1])] = start
+            values[name] = json.loads(bytes(buf[pos:_json_skip(buf, pos)]))
+    return values, offsets
+
+
+def _yaml_skip(events, event):
+    # consume the events of a node starting with event
+    nodes = [event]
+    depth = 1 if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)) else 0
+    while depth:
+        event = next(events)
+        nodes.append(event)
+        if isinstance(event, (yaml.MappingStartEvent, yaml.SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (yaml.MappingEndEvent, yaml.SequenceEndEvent)):
+            depth -= 1
+    return nodes
+
+
+class _YamlDone(Exception):
+    # all key paths are found, stop parsing
+    pass
+
+
+class _YamlAlias(Exception):
+    # an alias or merge key on a key path, resolved by loading the whole document
+    pass
+
+
+def _yaml_merge(event):
+    return isinstance(event, yaml.ScalarEvent) and event.value == "<<" and (
+        event.tag == "tag:yaml.org,2002:merge" or (event.tag is None and event.implicit[0]))
+
+
+def _yaml_walk(events, event, paths, found, wanted):
+    # match the key paths (names mapped to remaining steps) in the node starting
+    # with event, collecting the events of each node found; consumes the node
+    if isinstance(event, yaml.AliasEvent):
+        raise _YamlAlias()
+    ends = [ name for name, steps in paths.items() if not steps ]
+    if ends:
+        nodes = _yaml_skip(events, event)
+        if any(isinstance(node, yaml.AliasEvent) for node in nodes):
+            raise _YamlAlias()
+        for name in ends:
+            found[name] = nodes
+        deeper = { name: steps for name, steps in paths.items() if steps }
+        if deeper:
+            inner = iter(nodes)
+            _yaml_walk(inner, next(inner), deeper, found, wanted)
+        if len(found) == wanted:
+            raise _YamlDone()
+        return
+    if isinstance(event, yaml.SequenceStartEvent):
+        i = 0
+        while True:
+            item = next(events)
+            if isinstance(item, yaml.SequenceEndEvent):
+                return
+            sub = { name: steps[1:] for name, steps in paths.items() if steps[0] == i
+                and isinstance(steps[0], int) }
+            if sub:
+                _yaml_walk(events, item, sub, found, wanted)
+            else:
+                _yaml_skip(events, item)
+            i += 1
+    elif isinstance(event, yaml.MappingStartEvent):
+        while True:
+            key = next(events)
+            if isinstance(key, yaml.MappingEndEvent):
+                return
+            nodes = _yaml_skip(events, key)
+            if _yaml_merge(key):
+                # keys merged from other mappings may be on the key paths
+                raise _YamlAlias()
+            value = next(events)
+            sub = {}
+            if len(nodes) == 1 and isinstance(key, yaml.ScalarEvent):
+                sub = { name: steps[1:] for name, steps in paths.items()
+                    if isinstance(steps[0], str) and steps[0] == key.value }
+            if sub:
+                _yaml_walk(events, value, sub, found, wanted)
+            else:
+                _yaml_skip(events, value)
+    else:
+        _yaml_skip(events, event)
+
+
+def _find_keys(obj, paths):
+    # values of key paths in a parsed document
+    values = {}
+    for name, steps in paths.items():
+        value = obj
+        for step in steps:
+            if isinstance(step, int) and isinstance(value, list) and step < len(value):
+                value = value[step]
+            elif isinstance(step, str) and isinstance(value, dict) and step in value:
+                value = value[step]
+            else:
+                break
+        else:
+            values[name] = value
+    return values
+
+
+def _read_yaml_keys(path, paths):
+    # values of key paths from a YAML file, parsing the events once without
+    # building objects, and stopping when all key paths are found
+    loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+    found = {}
+    with _open(path, "r") as fs:
+        events = yaml.parse(fs, Loader = loader)
+        for event in events:
+            if isinstance(event, yaml.DocumentStartEvent):
+                try:
+                    _yaml_walk(events, next(events), paths, found, len(paths))
+                except _YamlDone:
+                    pass
+                except _YamlAlias:
+                    return _find_keys(read_yaml(path), paths)
+                break
+    values = {}
+    for name, nodes in found.items():
+        text = yaml.emit([yaml.StreamStartEvent(), yaml.DocumentStartEvent()] + nodes +
+            [yaml.DocumentEndEvent(), yaml.StreamEndEvent()])
+        values[name] = yaml.safe_load(text)
+    return values
+
+
+@metrics.timed("io.read_keys", _file_size)
+def read_keys(path, keys, default = None, index = False):
+    """Read selected values from a JSON or YAML file.
+
+    Parse only the values at the given key paths, instead of the whole
+    document as with :func:`read_json` or :func:`read_yaml`.
+    Other values are skipped without building python objects.
+
+    Key paths are given as keys separated by dots, and list positions
+    in brackets, e.g. `a.b[3].c`, optionally starting with `$` and with
+    quoted keys, e.g. `$.a['b.c']`.
+
+    For uncompressed JSON files, the positions of the values found can be kept
+    in an index file. Later reads from the same, unchanged file continue
+    from the deepest value in the index, e.g. for `a.b[3].c` read after `a.b`,
+    or read values known from the index directly.
+    YAML files with aliases or merge keys (`<<`) on a key path are loaded as a whole.
+
+    Args:
+        path (str): File path, the format is detected by :func:`sniff`.
+        keys (str or list): A key path, or a list of key paths.
+        default: A value returned for missing key paths.
+        index (bool or str): Keep an index of positions in the file at `path` + `.idx`,
+            or at the path given.
+
+    Returns:
+        The value at the key path, or a dictionary of key paths and values
+        if `keys` is a list.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        print(miscset.io.read_keys("tests/example.json", ["example_list[1]", "missing"]))
+    """
+    single = isinstance(keys, str)
+    names = [keys] if single else list(keys)
+    paths = { name: _parse_keys(name) for name in names }
+    format = sniff(path)
+    if format == "json":
+        if index is True:
+            index = str(path) + ".idx"
+        st = os.stat(path)
+        state = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+        offsets = {}
+        if index and _compression(path, "infer") is None and os.path.isfile(index):
+            stored = read_json(index)
+            if stored.get("state") == state:
+                offsets = stored.get("offsets", {})
+        values, new = _read_json_keys(path, paths, offsets)
+        if index and _compression(path, "infer") is None and new != offsets:
+            write_json(index, {"path": os.path.abspath(path), "state": state, "offsets": new})
+    elif format == "yaml":
+        values = _read_yaml_keys(path, paths)
+    else:
+        raise Exception("There is no such format")
+    if single:
+        return values.get(keys, default)
+    return { name: values.get(name, default) for name in names }
+
+
+### series
+
+
+class TiffSeries(object):
+    """A lazy array of many TIFF files.
+
+    Index a list of single page TIFF files, e.g. a time series found by
+    :func:`miscset.files.find`, as one array with the file as first dimension.
+    Only the frames selected by indexing or slicing are read.
+    Shape and data type are taken from the first file, and each other file
+    is validated when read.
+
+    Frames read are kept in a cache of the least recently used frames.
+    When frames are accessed in increasing order, the following frames are read
+    in the background by a pool of threads, so that iterating over windows of
+    frames does not wait for reading the files.
+
+    Args:
+        paths (list): Paths to TIFF files, one frame each.
+        cache_size (int): Maximum number of frames to keep in memory.
+        prefetch (int): Number of frames to read ahead. 0 to disable.
+        workers (int): Number of threads reading frames in the background.
+
+    Attributes:
+        paths (list): The file paths.
+        shape (tuple): Number of frames and the shape of a frame.
+        dtype (numpy.dtype): The data type of a frame.
+
+    .. code-block:: python
+
+        import miscset
+        paths = sorted(miscset.files.find("images", extensions = ["tif"]))
+        with miscset.io.TiffSeries(paths) as series:
+            print(series.shape)
+            window = series[100:110, 0:64, 0:64]
+    """
+
+    def __init__(self, paths, cache_size = 64, prefetch = 4, workers = 2):
+        self.paths = list(paths)
+        if not self.paths:
+            raise Exception("There are no files")
+        with tifffile.TiffFile(self.paths[0]) as tif:
+            page = tif.pages[0]
+            self.shape = (len(self.paths),) + tuple(page.shape)
+            self.dtype = numpy.dtype(page.dtype)
+        self.cache_size = max(cache_size, prefetch + 1)
+        self.prefetch = prefetch
+        self._cache = collections.OrderedDict()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last = -1
+        self._pool = None
+        if prefetch or workers > 1:
+            self._pool = concurrent.futures.ThreadPoolExecutor(max(1, workers))
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __repr__(self):
+        return "<miscset.io.TiffSeries: shape={}, dtype={}>".format(self.shape, self.dtype)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """Stop reading in the background and clear the cache."""
+        if self._pool is not None:
+            with self._lock:
+                for future in self._pending.values():
+                    future.cancel()
+            self._pool.shutdown(wait = True)
+            self._pool = None
+        with self._lock:
+            self._cache.clear()
+
+    def _read(self, i):
+        path = self.paths[i]
+        img = tifffile.imread(path, key = 0)
+        if img.shape != self.shape[1:] or img.dtype != self.dtype:
+            raise ValueError("frame {} at {} has shape {} and type {}, expected {} and {}".format(
+                i, path, img.shape, img.dtype, self.shape[1:], self.dtype))
+        # frames are shared by the cache
+        img.flags.writeable = False
+        return img
+
+    def _load(self, i):
+        try:
+            img = self._read(i)
+            with self._lock:
+                self._cache[i] = img
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last = False)
+            return img
+        finally:
+            with self._lock:
+                self._pending.pop(i, None)
+
+    def _submit(self, i):
+        # read a frame in the background, call with the lock held,
+        # returns the future reading the frame or None if cached
+        if i in self._cache or self._pool is None:
+            return None
+        if i not in self._pending:
+            self._pending[i] = self._pool.submit(self._load, i)
+        return self._pending[i]
+
+    def frame(self, i):
+        """Read a single frame.
+
+        Args:
+            i (int): Frame index.
+
+        Returns:
+            numpy.ndarray: The frame (read-only).
+        """
+        return self._frames([i])[0]
+
+    def _frames(self, indices):
+        n = len(self)
+        indices = [ int(i) + n if i < 0 else int(i) for i in indices ]
+        for i in indices:
+            if not 0 <= i < n:
+                raise IndexError("frame index {} out of range".format(i))
+        # keep the futures of this call, as the cache may drop
+        # frames of a slice larger than the cache before they are collected
+        futures = {}
+        with self._lock:
+            if len(indices) > 1:
+                for i in indices:
+                    future = self._submit(i)
+                    if future is not None:
+                        futures[i] = future
+            # read ahead when moving forward
+            if self.prefetch and indices and indices[0] > self._last:
+                last = max(indices)
+                for i in range(last + 1, min(last + 1 + self.prefetch, n)):
+                    self._submit(i)
+                self._last = last
+        frames = []
+        for i in indices:
+            with self._lock:
+                img = self._cache.get(i)
+                if img is not None:
+                    self._cache.move_to_end(i)
+                future = futures.get(i) or self._pending.get(i)
+            if img is None:
+                img = future.result() if future is not None else self._load(i)
+            frames.append(img)
+        return frames
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        if not key:
+            key = (slice(None),)
+        first, rest = key[0], key[1:]
+        if first is None:
+            return self[rest][numpy.newaxis]
+        if first is Ellipsis:
+            # the ellipsis covers the frame dimension, unless all dimensions are indexed
+            if sum(k is not None and k is not Ellipsis for k in rest) >= len(self.shape):
+                return self[rest]
+            first, rest = slice(None), key
+        if isinstance(first, (int, numpy.integer)):
+            return self.frame(first)[rest]
+        if isinstance(first, slice):
+            indices = range(*first.indices(len(self)))
+        else:
+            indices = numpy.asarray(first)
+            if indices.dtype == bool:
+                if indices.shape != (len(self),):
+                    raise IndexError("boolean index must have the length of the series")
+                indices = numpy.flatnonzero(indices)
+            if indices.dtype.kind not in "iu":
+                raise IndexError("frames are indexed by integers, slices, "
+                    "integer or boolean arrays, ... or None")
+            indices = indices.reshape(-1)
+        frames = [ img[rest] for img in self._frames(list(indices)) ]
+        if not frames:
+            empty = numpy.empty(self.shape[1:], self.dtype)[rest]
+            return numpy.empty((0,) + empty.shape, self.dtype)
+        return numpy.stack(frames)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def __array__(self, dtype = None, copy = None):
+        return numpy.asarray(self[:], dtype = dtype)
+
+
 ### output
 
 
-def write_txt(text, path):
+def write_txt(text, path, buffering = -1, fsync = False, compression = "infer", atomic = True):
     """Write text to a file.
 
     A file at a path is opened writable,
     and the text from a string variable is inserted.
+    The text is written to a temporary file first, which then replaces
+    the file at `path`, so that no partially written file is ever visible.
 
     Args:
         text (str): Text to write to a file at `path`.
         path (str): File path.
+        buffering (int): Buffer size in bytes for uncompressed files, see `open`.
+        fsync (bool): Flush the file (and its folder entry) to disk before returning.
+        compression (str): One of 'gzip', 'zstd', 'lz4', `None` for none,
+            or 'infer' to choose by the extension of `path`.
+        atomic (bool): Write via a temporary file. If `False`,
+            write to `path` directly.
     """
-    fs = open(path, "w")
-    fs.write(text)
-    fs.close()
+    compression = _compression(path, compression)
+    if not atomic:
+        with _open(path, "w", buffering, compression = compression) as fs:
+            fs.write(text)
+        return
+    with _atomic(path, fsync) as tmp:
+        with _open(tmp, "w", buffering, compression = compression) as fs:
+            fs.write(text)
     return
 
 
@@ -255,14 +1262,25 @@ def write_stderr(text, newline = True):
     return
 
 
-def write_json(path, obj, default = repr):
+def write_json(path, obj, default = repr, buffering = -1, fsync = False,
+    compression = "infer", atomic = True):
     """Write an object representation to a json file.
     
     See https://docs.python.org/3/library/json.html#json.dump
+
+    The file is written atomically and optionally compressed,
+    see :func:`write_txt` for the arguments `buffering`,
+    `fsync`, `compression` and `atomic`.
     """
-    fs = open(path, "w")
-    fs.write(json.dumps(obj, default = default))
-    fs.close()
+    compression = _compression(path, compression)
+    if not atomic:
+        with _open(path, "w", buffering, compression = compression) as fs:
+            # dumps encodes in one shot with the C encoder, dump only with the python one
+            fs.write(json.dumps(obj, default = default))
+        return
+    with _atomic(path, fsync) as tmp:
+        with _open(tmp, "w", buffering, compression = compression) as fs:
+            fs.write(json.dumps(obj, default = default))
 
 
 class Parsable(object):
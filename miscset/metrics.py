@@ -0,0 +1,203 @@
+"""Counters and latency histograms.
+
+Methods of this package, such as :func:`miscset.sh.run`, the readers in
+:py:mod:`miscset.io` and :func:`miscset.files.find`, record the number of calls,
+their duration, and the amount of data processed (bytes read, entries scanned).
+Recording is disabled by default and costs a single flag check per call then.
+
+Enable recording for a block of code, and export the values as a dictionary
+or as text in the `Prometheus <https://prometheus.io>`_ exposition format:
+
+.. exec_code::
+    :caption: Example code:
+    :caption_output: Result:
+
+    import miscset
+    with miscset.metrics.recording() as registry:
+        miscset.io.read_yaml("tests/example.yml")
+        miscset.files.find("tests")
+    print(registry.to_prometheus())
+"""
+
+
+import re
+import time
+import functools
+import threading
+import contextlib
+
+
+BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0, float("inf"))
+"""Upper bounds in seconds of the latency histogram buckets."""
+
+
+class Histogram(object):
+    """A latency histogram.
+
+    Counts observations per bucket of :py:data:`BUCKETS`, and sums up
+    the observed values.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def observe(self, value):
+        """Add a value (seconds) to the histogram."""
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+
+    def to_dict(self):
+        """Return count, sum and cumulative bucket counts as dictionary."""
+        cumulative = {}
+        total = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            total += n
+            cumulative[bound] = total
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class Registry(object):
+    """A collection of named counters and histograms.
+
+    Args:
+        enabled (bool): Record values. If `False`, calls to
+            :meth:`add` and :meth:`observe` are ignored.
+    """
+
+    def __init__(self, enabled = False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Remove all recorded values."""
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def add(self, name, value = 1):
+        """Increase a counter by a value."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """Add a duration to a histogram."""
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def to_dict(self):
+        """Return all values as a dictionary.
+
+        Returns:
+            dict: The format is `{"counters": {name -> value},
+                "histograms": {name -> {"count", "sum", "buckets"}}}`.
+        """
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": {k: v.to_dict() for k, v in self.histograms.items()},
+            }
+
+    def to_prometheus(self, prefix = "miscset"):
+        """Return all values as Prometheus text.
+
+        Counter names get the suffix `_total`, histogram names
+        the suffix `_seconds`.
+
+        Args:
+            prefix (str): A prefix added to each metric name.
+
+        Returns:
+            str: Text in the Prometheus exposition format.
+        """
+        def metric(name):
+            name = "_".join([prefix, name]) if prefix else name
+            return re.sub("[^a-zA-Z0-9_:]", "_", name)
+        values = self.to_dict()
+        lines = []
+        for name, value in sorted(values["counters"].items()):
+            name = metric(name)
+            lines.append(f"# TYPE {name}_total counter")
+            lines.append(f"{name}_total {value}")
+        for name, histogram in sorted(values["histograms"].items()):
+            name = metric(name) + "_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for bound, n in histogram["buckets"].items():
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{{le=\"{le}\"}} {n}")
+            lines.append(f"{name}_sum {histogram['sum']}")
+            lines.append(f"{name}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+"""The :class:`Registry` used by the methods of this package."""
+
+
+def add(name, value = 1):
+    """Increase a counter of the :py:data:`registry` by a value."""
+    registry.add(name, value)
+
+
+@contextlib.contextmanager
+def recording(reset = True):
+    """Enable recording to the :py:data:`registry` within a `with` block.
+
+    Args:
+        reset (bool): Remove values recorded before.
+
+    Yields:
+        Registry: The :py:data:`registry`.
+    """
+    enabled = registry.enabled
+    if reset:
+        registry.reset()
+    registry.enabled = True
+    try:
+        yield registry
+    finally:
+        registry.enabled = enabled
+
+
+def timed(name, size = None):
+    """Decorate a function to record its calls and duration.
+
+    A histogram `name` records the duration of each call.
+    Without recording enabled, the function is called directly.
+
+    Args:
+        name (str): The histogram name.
+        size (callable): A function called with the arguments of the
+            decorated function, returning the amount of data processed
+            (e.g. bytes), which is added to the counter `<name>.bytes`.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not registry.enabled:
+                return func(*args, **kwargs)
+            if size is not None:
+                try:
+                    registry.add(name + ".bytes", size(*args, **kwargs))
+                except (OSError, TypeError, ValueError):
+                    pass
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                registry.observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -1,14 +1,24 @@
 """Shell subprocesses.
 
-Features an ANSI shell colors and an extended
-wrapper for the :py:func:`subprocess.run` method.
+Features an ANSI shell colors, a buffered writer of colored text, and an extended
+wrapper for the :py:func:`subprocess.run` method,
+also running a command at many hosts at once.
 """
 
 
 import os
+import re
+import sys
+import time
+import signal
 import getpass
+import tempfile
+import threading
 import subprocess
+import concurrent.futures
 import logging
+import pandas
+from . import metrics
 
 
 logger = logging.getLogger()
@@ -64,7 +74,256 @@ def print_colored(text, color, reset = True):
     print(text)
 
 
-def run(cmd, remote = None, user = None, piped = True, env = None):
+class ColorWriter(object):
+    """A buffered writer of ansi colored text.
+
+    Collects text in a buffer and writes it to the stream in large chunks,
+    which is much faster than :func:`print_colored` for many lines.
+    Colors are only added if the stream is a terminal (and the environment
+    variable `NO_COLOR` is not set), otherwise text is written as is.
+
+    Args:
+        stream (file): A text stream to write to. If given `None`, use :py:data:`sys.stdout`.
+        colors (bool): Add color sequences. If given `None`, detect whether
+            `stream` is a terminal.
+        buffer_size (int): Number of characters to collect before writing.
+        rules (list): Tuples of a regular expression and an :class:`AnsiColor` value.
+            Lines written without a color get the color of the first
+            expression found in the line.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        rules = [("error", miscset.sh.AnsiColor.red), ("ok", miscset.sh.AnsiColor.green)]
+        with miscset.sh.ColorWriter(rules = rules) as writer:
+            writer.writelines(["step 1 ok", "step 2 error", ("done", miscset.sh.AnsiColor.cyan)])
+    """
+
+    def __init__(self, stream = None, colors = None, buffer_size = 2**16, rules = None):
+        if stream is None:
+            stream = sys.stdout
+        if colors is None:
+            isatty = getattr(stream, "isatty", None)
+            colors = bool(isatty and isatty()) and "NO_COLOR" not in os.environ
+        self.stream = stream
+        self.colors = colors
+        self.buffer_size = buffer_size
+        self.rules = [ (re.compile(regex), color) for regex, color in (rules or []) ]
+        self._buffer = []
+        self._size = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def _color(self, text):
+        for regex, color in self.rules:
+            if regex.search(text):
+                return color
+        return None
+
+    def write(self, text, color = None):
+        """Add text, decorated with a color, to the buffer.
+
+        Args:
+            text (str): A text to write.
+            color (str): An :class:`AnsiColor` value, or `None` for no color.
+        """
+        if color and self.colors:
+            text = color + text + AnsiColor.reset
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self.flush(stream = False)
+
+    def writelines(self, lines):
+        """Add lines to the buffer.
+
+        Args:
+            lines (iterable): Strings, colored by the `rules`, or tuples of
+                a string and an :class:`AnsiColor` value (or `None`).
+                A line separator is added to each line.
+        """
+        buffer = self._buffer
+        size = self._size
+        colors = self.colors
+        rules = self.rules
+        reset = AnsiColor.reset
+        newline = os.linesep
+        for line in lines:
+            if isinstance(line, str):
+                color = self._color(line) if rules and colors else None
+            else:
+                line, color = line
+            if color and colors:
+                line = color + line + reset + newline
+            else:
+                line = line + newline
+            buffer.append(line)
+            size += len(line)
+            if size >= self.buffer_size:
+                self._size = size
+                self.flush(stream = False)
+                buffer = self._buffer
+                size = 0
+        self._size = size
+
+    def write_table(self, df, colors = None, index = True):
+        """Add a table with colored cells to the buffer.
+
+        Values are right aligned in columns as wide as their longest value.
+
+        Args:
+            df (pandas.DataFrame): A table.
+            colors (pandas.DataFrame or callable): A table of the same shape as `df`
+                holding an :class:`AnsiColor` value (or `None`) per cell,
+                or a function called with a value returning its color.
+            index (bool): Add the row labels as first column.
+        """
+        cells = df.astype(str)
+        if index:
+            cells.insert(0, "", df.index.astype(str))
+        header = [ str(column) for column in cells.columns ]
+        widths = [ max([len(h)] + cells.iloc[:, i].str.len().tolist())
+            for i, h in enumerate(header) ]
+        if colors is None:
+            palette = None
+        elif callable(colors):
+            # DataFrame.map requires pandas 2.1, map the columns instead
+            palette = df.apply(lambda column: column.map(colors))
+        else:
+            palette = colors
+        lines = [ " ".join(h.rjust(w) for h, w in zip(header, widths)) ]
+        offset = 1 if index else 0
+        for i, row in enumerate(cells.itertuples(index = False, name = None)):
+            parts = []
+            for j, (value, width) in enumerate(zip(row, widths)):
+                value = value.rjust(width)
+                color = None
+                if palette is not None and j >= offset:
+                    color = palette.iat[i, j - offset]
+                # missing colors may be None or NaN
+                if isinstance(color, str) and color and self.colors:
+                    value = color + value + AnsiColor.reset
+                parts.append(value)
+            lines.append(" ".join(parts))
+        self.writelines(lines)
+
+    def flush(self, stream = True):
+        """Write the buffer to the stream.
+
+        Args:
+            stream (bool): Flush the stream as well.
+        """
+        if self._buffer:
+            self.stream.write("".join(self._buffer))
+            self._buffer = []
+            self._size = 0
+        if stream:
+            self.stream.flush()
+
+
+_RLIMITS = {
+    "cpu": ("-t", 1),
+    "memory": ("-v", 1024),
+    "files": ("-n", 1),
+}
+# ulimit option and ulimit unit in bytes per limit name
+
+
+def _ulimit(limits):
+    # shell commands setting soft resource limits, capped at the hard limits,
+    # run by the shell itself rather than in a preexec_fn, which is unsafe with threads
+    cmd = ""
+    for name, value in limits.items():
+        if name not in _RLIMITS:
+            raise Exception("There is no such limit")
+        option, unit = _RLIMITS[name]
+        cmd += "ulimit -S {0} {1} 2>/dev/null || ulimit -S {0} $(ulimit -H {0});".format(
+            option, int(value) // unit)
+    return cmd
+
+
+def _wait4(pid, deadline):
+    # reap a process and return its status and resource usage, or None at the deadline
+    while True:
+        flags = 0 if deadline is None else os.WNOHANG
+        waited, status, rusage = os.wait4(pid, flags)
+        if waited:
+            return status, rusage
+        if time.monotonic() >= deadline:
+            return None
+        time.sleep(0.005)
+
+
+def _execute(command, pipe_input, timeout):
+    # run a shell command like subprocess.run with captured output,
+    # but reap it with wait4 to obtain its resource usage
+    start = time.monotonic()
+    deadline = None if timeout is None else start + timeout
+    proc = subprocess.Popen(
+        command,
+        stdin = None if pipe_input is None else subprocess.PIPE,
+        stdout = subprocess.PIPE,
+        stderr = subprocess.PIPE,
+        text = True,
+        shell = True,
+        start_new_session = timeout is not None)
+    output = {}
+    def read(name, fs):
+        output[name] = fs.read()
+        fs.close()
+    def write():
+        try:
+            proc.stdin.write(pipe_input)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    threads = [threading.Thread(target = read, args = ("stdout", proc.stdout)),
+        threading.Thread(target = read, args = ("stderr", proc.stderr))]
+    if pipe_input is not None:
+        threads.append(threading.Thread(target = write))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join(None if deadline is None else max(0, deadline - time.monotonic()))
+    waited = None
+    if not any(thread.is_alive() for thread in threads):
+        waited = _wait4(proc.pid, deadline)
+    if waited is None:
+        # timeout, kill the whole process group started for the command
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            proc.kill()
+        for thread in threads:
+            thread.join()
+        _wait4(proc.pid, None)
+        proc.returncode = -signal.SIGKILL
+        raise subprocess.TimeoutExpired(command, timeout,
+            output = output.get("stdout"), stderr = output.get("stderr"))
+    status, rusage = waited
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    run = subprocess.CompletedProcess(command, proc.returncode,
+        output["stdout"], output["stderr"])
+    # ru_maxrss is given in kilobytes on linux, but in bytes on macos
+    maxrss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    run.rusage = {"utime": rusage.ru_utime, "stime": rusage.ru_stime,
+        "maxrss": maxrss, "wall": time.monotonic() - start}
+    return run
+
+
+@metrics.timed("sh.run")
+def run(cmd, remote = None, user = None, piped = True, env = None, timeout = None,
+    limits = None):
     """Run a (series of) shell command(s) as user at a host.
 
     Wraps the `subprocess.run` method by adding features like:
@@ -75,6 +334,7 @@ def run(cmd, remote = None, user = None, piped = True, env = None):
         - the remote shell using a specified user login at a host via `ssh <user>@<host>`
     - supply environment paths exported in the shell prior to executing the command
     - return error code, stdout, stderr to a logger from the `logging` module as debug message
+    - limit the runtime and resources of the command, and report its resource usage
 
     Args:
         cmd (str): A string used as shell command.
@@ -83,10 +343,22 @@ def run(cmd, remote = None, user = None, piped = True, env = None):
             switch to using sudo for localhost.
         piped (bool): Enable using `bash -s` to pipe commands to shell.
         env (str): Folder paths to use and export in PATH shell variable.
+        timeout (float): Seconds to wait for the command to finish,
+            otherwise kill the runner and all processes it started (its process group)
+            and raise :py:class:`subprocess.TimeoutExpired`.
+            For a `remote` command, only the local ssh client is killed.
+        limits (dict): Resource limits applied to the command, with the keys
+            'cpu' (seconds of CPU time), 'memory' (bytes of address space)
+            and 'files' (number of open files), set with `ulimit` by the shell
+            running the command. Limits above the hard limits are lowered to those.
 
     Returns:
         :py:class:`subprocess.CompletedProcess`: An object holding args, returncode and stdout/stderr values
-            from the executed subprocess.
+            from the executed subprocess. Its attribute `rusage` is a dictionary
+            of the resources used by the runner and the processes it waited for,
+            with the keys 'utime' and 'stime' (user and system CPU seconds),
+            'maxrss' (maximum resident memory in bytes) and 'wall' (seconds).
+            For a `remote` command, these are the resources of the local ssh client.
 
     .. exec_code::
             :caption: Example code:
@@ -98,8 +370,12 @@ def run(cmd, remote = None, user = None, piped = True, env = None):
     """
     if env is None:
         env = []
+    if limits is None:
+        limits = {}
     if remote in ["localhost", "127.0.0.1"]:
         remote = None
+    if limits:
+        cmd = _ulimit(limits) + cmd
     if remote:
         runner = ["ssh"]
         if user:
@@ -132,17 +408,10 @@ def run(cmd, remote = None, user = None, piped = True, env = None):
     if piped:
         pipe_input = cmd
     if remote and len(env):
-        logger.debug("shell paths are {}".format(env))
-    logger.debug("shell stdin is {}".format(pipe_input))
-    logger.debug("shell runner is {}".format(runner))
-    run = subprocess.run(
-        " ".join(runner),
-        input = pipe_input,
-        text = True,
-        universal_newlines = True,
-        capture_output = True,
-        bufsize = 0,
-        shell = True)
+        logger.debug("shell paths are %s", env)
+    logger.debug("shell stdin is %s", pipe_input)
+    logger.debug("shell runner is %s", runner)
+    run = _execute(" ".join(runner), pipe_input, timeout)
     def prettify(std):
         std = std.split(os.linesep)
         std = [ line for line in std if len(line) ]
@@ -150,8 +419,250 @@ def run(cmd, remote = None, user = None, piped = True, env = None):
             std = [""] + std
         std = os.linesep.join(std)
         return std
-    logger.debug("shell stdout is {}".format(prettify(run.stdout)))
-    logger.debug("shell stderr is {}".format(prettify(run.stderr)))
-    logger.debug("shell return code is {}".format(run.returncode))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("shell stdout is %s", prettify(run.stdout))
+        logger.debug("shell stderr is %s", prettify(run.stderr))
+    logger.debug("shell return code is %s", run.returncode)
+    logger.debug("shell resource usage is %s", run.rusage)
+    metrics.add("sh.run.bytes", len(run.stdout) + len(run.stderr))
     return run
 
+
+
+def _run_host(cmd, host, user, env, timeout, retries, backoff):
+    # run at a single host, retrying on ssh connection errors and timeouts
+    start = time.monotonic()
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(backoff * 2 ** (attempt - 1))
+        try:
+            out = run(cmd, remote = host, user = user, env = env, timeout = timeout)
+            returncode, stdout, stderr = out.returncode, out.stdout, out.stderr
+        except subprocess.TimeoutExpired:
+            returncode, stdout, stderr = None, "", "timeout after {} seconds".format(timeout)
+        # ssh exits with 255 if the connection failed
+        if returncode not in [None, 255]:
+            break
+    return {"host": host, "returncode": returncode, "stdout": stdout,
+        "stderr": stderr, "duration": time.monotonic() - start, "attempts": attempt + 1}
+
+
+def broadcast(cmd, hosts, user = None, env = None, workers = 16, timeout = None,
+    retries = 0, backoff = 1.0, group = False):
+    """Run a (series of) shell command(s) at many hosts.
+
+    Calls :func:`run` for each host concurrently, and collects the results in a table.
+
+    Args:
+        cmd (str): A string used as shell command.
+        hosts (list): Names of remote servers.
+        user (str): A user name to connect with ssh, see :func:`run`.
+        env (str): Folder paths to export in the PATH shell variable, see :func:`run`.
+        workers (int): Maximum number of hosts to run at the same time.
+        timeout (float): Seconds to wait for the command at a host.
+        retries (int): Number of times to retry a host, if the ssh connection
+            failed (return code 255) or timed out.
+        backoff (float): Seconds to wait before the first retry,
+            doubled for each further retry.
+        group (bool): Summarize hosts with identical output in one row each.
+
+    Returns:
+        pandas.DataFrame: A table with the columns host, returncode, stdout,
+            stderr, duration (seconds) and attempts, in the order of `hosts`.
+            The return code is `None` if the command timed out.
+            If `group` is set, a table with the columns returncode, stdout, stderr,
+            count and hosts (a list of host names) instead, ordered by count.
+
+    .. code-block:: python
+
+        import miscset
+        print(miscset.sh.broadcast("uname -r", ["node1", "node2"], group = True))
+    """
+    hosts = list(hosts)
+    with concurrent.futures.ThreadPoolExecutor(max(1, min(workers, len(hosts) or 1))) as pool:
+        futures = [ pool.submit(_run_host, cmd, host, user, env, timeout, retries, backoff)
+            for host in hosts ]
+        results = [ future.result() for future in futures ]
+    columns = ["host", "returncode", "stdout", "stderr", "duration", "attempts"]
+    df = pandas.DataFrame(results, columns = columns)
+    df["returncode"] = df["returncode"].astype("object")
+    if not group:
+        return df
+    keys = ["returncode", "stdout", "stderr"]
+    grouped = df.groupby(keys, sort = False, dropna = False)["host"].agg(list).reset_index(name = "hosts")
+    grouped.insert(3, "count", grouped["hosts"].map(len))
+    return grouped.sort_values("count", ascending = False, kind = "stable", ignore_index = True)
+
+
+def _argv(cmd, remote = None, user = None, env = None):
+    # arguments running a command at a local or remote shell, without a shell in between
+    if remote in ["localhost", "127.0.0.1"]:
+        remote = None
+    if env:
+        cmd = "export PATH=\"{}:$PATH\";".format(":".join(env)) + cmd
+    if remote:
+        host = "{}@{}".format(user, remote) if user else remote
+        return ["ssh", host, cmd]
+    if user and user != getpass.getuser():
+        return ["sudo", "-u", user, "bash", "-c", cmd]
+    return ["bash", "-c", cmd]
+
+
+class Pipeline(object):
+    """Shell commands running connected by pipes.
+
+    Created by :func:`pipeline`. The standard output of each command is
+    connected to the standard input of the next one by an operating system
+    pipe, so that data passes from process to process directly.
+    The output of the last command is streamed from :py:attr:`stdout`,
+    e.g. by iterating over the object line by line, or written to a file.
+
+    Use it as context manager to wait for all processes at the end.
+
+    Attributes:
+        processes (list): The :py:class:`subprocess.Popen` object of each stage.
+        stdout: The output stream of the last stage,
+            or `None` if written to a file.
+        returncodes (list): Return code of each stage, set by :meth:`wait`.
+        stderr (list): Standard error of each stage, set by :meth:`wait`.
+    """
+
+    def __init__(self, processes, errors, writer = None):
+        self.processes = processes
+        self.stdout = processes[-1].stdout
+        self.returncodes = None
+        self.stderr = None
+        self._errors = errors
+        self._writer = writer
+
+    def __iter__(self):
+        return iter(self.stdout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.wait()
+
+    def read(self):
+        """Read the remaining output of the last stage, and wait for all stages.
+
+        Returns:
+            str: The output (bytes if `text` was disabled).
+        """
+        out = self.stdout.read()
+        self.wait()
+        return out
+
+    def wait(self, timeout = None):
+        """Wait for all stages to finish.
+
+        Output of the last stage not read yet is discarded.
+
+        Args:
+            timeout (float): Seconds to wait for each stage,
+                otherwise raise :py:class:`subprocess.TimeoutExpired`.
+
+        Returns:
+            list: The return code of each stage.
+        """
+        if self.returncodes is not None:
+            return self.returncodes
+        if self.stdout is not None:
+            # unread output is discarded, it would block the last stage otherwise
+            self.stdout.close()
+        returncodes = [ proc.wait(timeout) for proc in self.processes ]
+        if self._writer is not None:
+            self._writer.join()
+        self.stderr = []
+        for fs in self._errors:
+            fs.seek(0)
+            self.stderr.append(fs.read().decode(errors = "replace"))
+            fs.close()
+        self.returncodes = returncodes
+        return returncodes
+
+
+def pipeline(stages, input = None, output = None, env = None, text = True):
+    """Run shell commands connected by pipes.
+
+    The same as `stage1 | stage2 | ...` in a shell, but each stage may run
+    at a different host, and the return codes of all stages are reported.
+    Data passes between stages directly through operating system pipes,
+    and never through python.
+
+    Args:
+        stages (list): Commands as strings, run by the local shell, or
+            dictionaries with the keys 'cmd', 'remote' and 'user'
+            (see :func:`run`) to run at a different host or as different user.
+        input (str, bytes or file): Standard input of the first stage. A file
+            (or file descriptor) is connected directly. If given `None`,
+            inherit the standard input of python.
+        output (str or file): A file path or file to connect to the standard
+            output of the last stage. If given `None`, stream the output
+            from :py:attr:`Pipeline.stdout`.
+        env (list): Folder paths to export in the PATH shell variable of each stage.
+        text (bool): Decode the output of the last stage as text.
+
+    Returns:
+        Pipeline: The running stages.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        with miscset.sh.pipeline(["printf 'b\\\\na\\\\n'", "sort"]) as pipe:
+            for line in pipe:
+                print(line.strip())
+        print(pipe.returncodes)
+    """
+    stages = [ {"cmd": stage} if isinstance(stage, str) else stage for stage in stages ]
+    if not stages:
+        raise Exception("There are no stages")
+    stdin = input
+    data = None
+    if isinstance(input, (str, bytes)):
+        stdin = subprocess.PIPE
+        data = input.encode() if isinstance(input, str) else input
+    close = None
+    if isinstance(output, (str, os.PathLike)):
+        output = close = open(output, "wb")
+    processes = []
+    errors = []
+    try:
+        for i, stage in enumerate(stages):
+            last = i == len(stages) - 1
+            argv = _argv(stage["cmd"], stage.get("remote"), stage.get("user"), env)
+            error = tempfile.TemporaryFile()
+            errors.append(error)
+            logger.debug("shell pipeline stage %s is %s", i, argv)
+            proc = subprocess.Popen(argv,
+                stdin = stdin,
+                stdout = output if last and output is not None else subprocess.PIPE,
+                stderr = error,
+                text = text and last and output is None)
+            if processes:
+                # the next stage holds the pipe now
+                processes[-1].stdout.close()
+            processes.append(proc)
+            stdin = proc.stdout
+    except BaseException:
+        for proc in processes:
+            proc.kill()
+        raise
+    finally:
+        if close is not None:
+            close.close()
+    writer = None
+    if data is not None:
+        first = processes[0].stdin
+        def write():
+            try:
+                first.write(data)
+                first.close()
+            except BrokenPipeError:
+                pass
+        writer = threading.Thread(target = write, daemon = True)
+        writer.start()
+    return Pipeline(processes, errors, writer)
@@ -1,6 +1,15 @@
-"""Methods to convert data to and from tables (DataFrames)."""
+"""Methods to convert data to and from tables (DataFrames).
 
+Tables can be converted chunk by chunk, using the methods prefixed `iter_`,
+and written to a file with :func:`write_df_chunks`, e.g. when read with
+``miscset.io.read_csv(path, chunksize = 100000)``. Rows from an iterator
+are collected to tables within a memory budget by
+:func:`iter_list_to_df` and :func:`iter_dict_to_df`.
+"""
 
+
+import os
+import itertools
 import pandas
 
 
@@ -68,4 +77,234 @@ def dict_to_df(d):
     Returns:
         pandas.DataFrame
     """
-    return pandas.DataFrame(data = d)
\ No newline at end of file
+    return pandas.DataFrame(data = d)
+
+
+### chunks
+
+
+def _memory(df):
+    return int(df.memory_usage(deep = True).sum())
+
+
+def _rows_to_df(rows, to_df, max_bytes):
+    # collect rows to tables of about `max_bytes`, as estimated from the
+    # memory per row of the previous table, or of a single row at first
+    rows = iter(rows)
+    start = 0
+    per_row = None
+    while True:
+        batch = []
+        if per_row is None:
+            batch = list(itertools.islice(rows, 1))
+            if not batch:
+                return
+            per_row = _memory(to_df(batch))
+        count = max(1, int(max_bytes // max(per_row, 1)))
+        batch += itertools.islice(rows, count - len(batch))
+        if not batch:
+            return
+        df = to_df(batch)
+        per_row = _memory(df) / len(df)
+        df.index = pandas.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+def df_chunks(chunks, max_bytes = None):
+    """Iterate over DataFrame chunks, split to a size budget.
+
+    Chunks larger than `max_bytes` are split by rows into smaller views,
+    which bounds the size of what is processed downstream per step.
+    The incoming chunks are already in memory and are not bounded,
+    so read large files in chunks, e.g. ``miscset.io.read_csv(path, chunksize = 100000)``.
+
+    Args:
+        chunks (iterable): DataFrames, or a single DataFrame.
+        max_bytes (int): Maximum size of a yielded chunk, estimated by
+            :py:meth:`pandas.DataFrame.memory_usage`. If given `None`,
+            chunks are not split.
+
+    Yields:
+        pandas.DataFrame: The chunks.
+    """
+    if isinstance(chunks, pandas.DataFrame):
+        chunks = [chunks]
+    for df in chunks:
+        if max_bytes is None or len(df) < 2:
+            yield df
+            continue
+        size = _memory(df)
+        if size <= max_bytes:
+            yield df
+            continue
+        rows = max(1, int(len(df) * max_bytes // size))
+        for i in range(0, len(df), rows):
+            yield df.iloc[i:i + rows]
+
+
+def iter_df_to_list(chunks, max_bytes = None):
+    """Convert DataFrame chunks to lists of lists.
+
+    The chunk-wise version of :func:`df_to_list`.
+
+    Args:
+        chunks (iterable): DataFrames, see :func:`df_chunks`.
+        max_bytes (int): See :func:`df_chunks`.
+
+    Yields:
+        list: A list of lists per chunk.
+    """
+    for df in df_chunks(chunks, max_bytes):
+        yield df_to_list(df)
+
+
+def iter_df_to_dict(chunks, max_bytes = None):
+    """Convert DataFrame chunks to dictionaries of lists.
+
+    The chunk-wise version of :func:`df_to_dict`.
+
+    Args:
+        chunks (iterable): DataFrames, see :func:`df_chunks`.
+        max_bytes (int): See :func:`df_chunks`.
+
+    Yields:
+        dict: A dictionary with the format `{column -> [values]}` per chunk.
+    """
+    for df in df_chunks(chunks, max_bytes):
+        yield df_to_dict(df)
+
+
+def iter_list_to_df(batches, colnames = None, transpose = True, max_bytes = None):
+    """Convert batches of lists of lists to DataFrames.
+
+    The chunk-wise version of :func:`list_to_df`. Each batch holds
+    the next rows of the table, arranged as given by `transpose`.
+    With `max_bytes`, single rows are read instead and collected to tables
+    within that budget, so that only one table is built at a time.
+
+    Args:
+        batches (iterable): 2-dimensional lists, see :func:`list_to_df`,
+            or rows (lists of values per column) if `max_bytes` is given.
+        colnames (list): See :func:`list_to_df`.
+        transpose (bool): See :func:`list_to_df`. Ignored for rows.
+        max_bytes (int): Maximum memory per table, estimated by
+            :py:meth:`pandas.DataFrame.memory_usage` of the previous table.
+
+    Yields:
+        pandas.DataFrame: A table per batch, with continuous row index.
+
+    .. exec_code::
+        :caption: Example code:
+        :caption_output: Result:
+
+        import miscset
+        rows = ([i, str(i)] for i in range(1000))
+        for df in miscset.tables.iter_list_to_df(rows, ["n", "s"], max_bytes = 20000):
+            print(len(df))
+    """
+    if max_bytes is not None:
+        def to_df(rows):
+            return list_to_df(rows, colnames, transpose = False)
+        yield from _rows_to_df(batches, to_df, max_bytes)
+        return
+    start = 0
+    for lol in batches:
+        df = list_to_df(lol, colnames, transpose)
+        df.index = pandas.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+def iter_dict_to_df(batches, max_bytes = None):
+    """Convert batches of dictionaries to DataFrames.
+
+    The chunk-wise version of :func:`dict_to_df`.
+    With `max_bytes`, single rows are read instead and collected to tables
+    within that budget, see :func:`iter_list_to_df`.
+
+    Args:
+        batches (iterable): Dictionaries formatted `{column -> [values]}`,
+            or rows formatted `{column -> value}` if `max_bytes` is given.
+        max_bytes (int): Maximum memory per table, see :func:`iter_list_to_df`.
+
+    Yields:
+        pandas.DataFrame: A table per batch, with continuous row index.
+    """
+    if max_bytes is not None:
+        yield from _rows_to_df(batches, pandas.DataFrame.from_records, max_bytes)
+        return
+    start = 0
+    for d in batches:
+        df = dict_to_df(d)
+        df.index = pandas.RangeIndex(start, start + len(df))
+        start += len(df)
+        yield df
+
+
+def _parquet_schema(table):
+    # infer a schema from the first chunk that later chunks can be cast to
+    import pyarrow
+    empty = [field.name for field, column in zip(table.schema, table.columns)
+        if len(column) > 0 and column.null_count == len(column)]
+    if empty:
+        raise ValueError(f"columns {empty} have no values in the first chunk "
+            "to infer their type from, pass a `schema`")
+    # integer columns become float as soon as a chunk has a missing value
+    return pyarrow.schema([
+        field.with_type(pyarrow.float64()) if pyarrow.types.is_integer(field.type) else field
+        for field in table.schema])
+
+
+def write_df_chunks(chunks, path, format = None, max_bytes = None, schema = None):
+    """Write DataFrame chunks to a file one by one.
+
+    Chunks are consumed one at a time, nothing else is kept from earlier ones.
+    Parquet files are written with the `pyarrow` package,
+    which needs to be installed for that format. Each chunk is cast to the
+    schema of the file, taken from `schema` or else inferred from the first
+    chunk. Inferred integer columns are stored as float, as a later chunk
+    may have missing values, and a column without any value in the first
+    chunk requires to pass a `schema`.
+
+    Args:
+        chunks (iterable): DataFrames with the same columns, see :func:`df_chunks`.
+        path (str): File path.
+        format (str): One of 'parquet' or 'csv'. If given `None`,
+            use 'parquet' for paths ending with `.parquet` or `.pq`, otherwise 'csv'.
+        max_bytes (int): See :func:`df_chunks`.
+        schema (pyarrow.Schema): The parquet schema. If given `None`,
+            infer it from the first chunk. Ignored for 'csv'.
+
+    Returns:
+        int: The number of rows written.
+    """
+    if format is None:
+        ext = os.path.splitext(str(path))[1].lower()
+        format = "parquet" if ext in [".parquet", ".pq"] else "csv"
+    rows = 0
+    if format == "parquet":
+        import pyarrow
+        import pyarrow.parquet
+        writer = None
+        try:
+            for df in df_chunks(chunks, max_bytes):
+                table = pyarrow.Table.from_pandas(df, preserve_index = False)
+                if writer is None:
+                    if schema is None:
+                        schema = _parquet_schema(table)
+                    writer = pyarrow.parquet.ParquetWriter(path, schema)
+                # columns of all NaN or None are typed float64 or null by pandas
+                writer.write_table(table.cast(writer.schema))
+                rows += len(df)
+        finally:
+            if writer is not None:
+                writer.close()
+    elif format == "csv":
+        with open(path, "w", newline = "") as fs:
+            for i, df in enumerate(df_chunks(chunks, max_bytes)):
+                df.to_csv(fs, header = i == 0, index = False)
+                rows += len(df)
+    else:
+        raise Exception("There is no such format")
+    return rows
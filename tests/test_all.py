@@ -9,6 +9,147 @@ import miscset
 def test_dt_now():
     assert type(miscset.dt.now()) == str
 
+def test_dt_formatter():
+    import datetime
+    dt = datetime.datetime(2021, 9, 30, 12, 0, 59, 123)
+    for fmt in ["dt", "d", "t", "f", "n"]:
+        assert miscset.dt.Formatter(fmt).format(dt) == miscset.dt.format(dt, fmt)
+    fmt = "%Y %% %I %p %H:%M:%S.%f"
+    assert miscset.dt.Formatter(fmt, False).format(dt) == dt.strftime(fmt)
+
+def test_dt_formatter_clock():
+    import datetime
+    clock = [0.5]
+    formatter = miscset.dt.Formatter("%S.%f", False, clock = lambda: clock[0])
+    assert formatter.now() == datetime.datetime.fromtimestamp(0.5).strftime("%S.%f")
+    clock[0] = 61.0
+    assert formatter() == datetime.datetime.fromtimestamp(61).strftime("%S.%f")
+
+def test_dt_parse():
+    import datetime
+    now = datetime.datetime(2021, 9, 30, 12, 0, 59)
+    for fmt in ["dt", "f", "n"]:
+        assert miscset.dt.parse(miscset.dt.format(now, fmt), fmt) == now
+    with pytest.raises(ValueError):
+        miscset.dt.parse("2021-02-29", "d")
+    for text in ["+1230101000000", " 1230101000000", "00000101000000"]:
+        with pytest.raises(ValueError):
+            miscset.dt.parse(text, "n")
+    for text in ["2021-9-3 1:2:3", "2021-09-30T12:00:59"]:
+        with pytest.raises(ValueError):
+            miscset.dt.parse(text, "dt")
+        with pytest.raises(ValueError):
+            miscset.dt.parse_many([text], "dt")
+
+def test_dt_parse_many():
+    import numpy
+    parsed = miscset.dt.parse_many(["2021-09-30_12-00-59", "2020-02-29_00-00-00"], "f")
+    assert parsed.dtype == numpy.dtype("datetime64[s]")
+    assert str(parsed[1]) == "2020-02-29T00:00:00"
+    with pytest.raises(ValueError):
+        miscset.dt.parse_many(["2021-02-29_00-00-00"], "f")
+    for texts in [["+1230101000000"], ["00000101000000"]]:
+        with pytest.raises(ValueError):
+            miscset.dt.parse_many(texts, "n")
+
+def test_dt_parse_many_input():
+    import numpy
+    import pandas
+    texts = ["20210930120059", "20211231235959"]
+    expected = miscset.dt.parse_many(texts, "n")
+    assert (miscset.dt.parse_many(pandas.Series(texts), "n") == expected).all()
+    assert (miscset.dt.parse_many(numpy.array(texts, dtype = object), "n") == expected).all()
+    strided = numpy.array([[t, "x"] for t in texts])[:, 0]
+    assert (miscset.dt.parse_many(strided, "n") == expected).all()
+
+
+## miscset.files
+
+
+def _watch_created(tmp_path, backend):
+    import threading
+    w = miscset.files.watch(str(tmp_path), extensions = ["txt"],
+        backend = backend, interval = 0.05, timeout = 5)
+    def touch():
+        (tmp_path / "skip.csv").write_text("x")
+        (tmp_path / "new.txt").write_text("x")
+    threading.Timer(0.2, touch).start()
+    return next(w)
+
+def test_files_watch_poll(tmp_path):
+    batch = _watch_created(tmp_path, "poll")
+    assert batch == [("created", str(tmp_path / "new.txt"))]
+
+def test_files_watch_inotify(tmp_path):
+    if miscset.files._libc() is None:
+        pytest.skip("inotify not available")
+    batch = _watch_created(tmp_path, "inotify")
+    assert batch == [("created", str(tmp_path / "new.txt"))]
+
+def test_files_watch_inotify_skipped(tmp_path):
+    import threading
+    if miscset.files._libc() is None:
+        pytest.skip("inotify not available")
+    w = miscset.files.watch(str(tmp_path), extensions = ["txt"],
+        backend = "inotify", timeout = 5)
+    threading.Timer(0.1, (tmp_path / "skip.csv").write_text, ["x"]).start()
+    threading.Timer(0.6, (tmp_path / "new.txt").write_text, ["x"]).start()
+    assert next(w) == [("created", str(tmp_path / "new.txt"))]
+
+def test_files_watch_inotify_moved(tmp_path):
+    import threading
+    if miscset.files._libc() is None:
+        pytest.skip("inotify not available")
+    root = tmp_path / "root"
+    (root / "sub").mkdir(parents = True)
+    (root / "sub" / "a.txt").write_text("x")
+    w = miscset.files.watch(str(root), backend = "inotify", timeout = 1)
+    threading.Timer(0.1, os.rename, [str(root / "sub"), str(tmp_path / "out")]).start()
+    assert next(w) == [("deleted", str(root / "sub" / "a.txt"))]
+    (tmp_path / "out" / "outside.txt").write_text("x")
+    assert list(w) == []
+
+def test_files_watch_inotify_rescan(tmp_path):
+    if miscset.files._libc() is None:
+        pytest.skip("inotify not available")
+    (tmp_path / "a.txt").write_text("x")
+    (tmp_path / "b.txt").write_text("x")
+    watcher = miscset.files._Inotify(str(tmp_path), True, lambda name: True)
+    try:
+        (tmp_path / "a.txt").unlink()
+        (tmp_path / "c.txt").write_text("x")
+        assert watcher.rescan() == [
+            ("created", str(tmp_path / "c.txt")), ("deleted", str(tmp_path / "a.txt"))]
+    finally:
+        watcher.close()
+
+def test_files_watch_max_delay(tmp_path):
+    import threading
+    import time
+    stop = threading.Event()
+    def append():
+        while not stop.is_set():
+            with open(str(tmp_path / "busy.log"), "a") as fs:
+                fs.write("x")
+            time.sleep(0.02)
+    threading.Thread(target = append, daemon = True).start()
+    try:
+        w = miscset.files.watch(str(tmp_path), interval = 0.01, max_delay = 0.3, timeout = 5)
+        start = time.monotonic()
+        assert len(next(w)) > 0
+        assert time.monotonic() - start < 2
+    finally:
+        stop.set()
+
+def test_files_watch_fallback(tmp_path, monkeypatch):
+    if miscset.files._libc() is None:
+        pytest.skip("inotify not available")
+    def fail(*args, **kwargs):
+        raise OSError(28, "no space left for watches")
+    monkeypatch.setattr(miscset.files._Inotify, "add", fail)
+    batch = _watch_created(tmp_path, None)
+    assert batch == [("created", str(tmp_path / "new.txt"))]
+
 
 ## miscset.io
 
@@ -34,3 +175,314 @@ def test_io_read_yaml_type():
 def test_io_read_yaml_value_None():
     assert xyaml["example_none"] is None
 
+
+def test_io_write_txt_atomic(tmp_path):
+    path = str(tmp_path / "out.txt")
+    miscset.io.write_txt("a\nb\n", path)
+    assert miscset.io.read_lines(path) == ["a", "b"]
+    assert os.listdir(str(tmp_path)) == ["out.txt"]
+
+def test_io_write_txt_keeps_mode_and_link(tmp_path):
+    path = tmp_path / "target.json"
+    miscset.io.write_txt("old", str(path))
+    os.chmod(str(path), 0o600)
+    link = tmp_path / "link.json"
+    os.symlink(str(path), str(link))
+    miscset.io.write_json(str(link), {"a": 1})
+    assert os.path.islink(str(link))
+    assert miscset.io.read_json(str(path)) == {"a": 1}
+    assert os.stat(str(path)).st_mode & 0o777 == 0o600
+
+def test_io_write_json_gzip(tmp_path):
+    path = str(tmp_path / "out.json.gz")
+    miscset.io.write_json(path, {"a": [1, 2]}, fsync = True)
+    assert miscset.io.read_json(path) == {"a": [1, 2]}
+    assert open(path, "rb").read(2) == b"\x1f\x8b"
+
+def test_io_load_sniff():
+    assert miscset.io.sniff("tests/example.yml") == "yaml"
+    assert miscset.io.sniff("tests/example.json") == "json"
+
+def test_io_load_cache(tmp_path):
+    cache = miscset.io.LoadCache(max_bytes = 1, spill = str(tmp_path / "spill"))
+    cache.put(("a", 1), {"a": 1})
+    cache.put(("b", 1), {"b": 1})
+    assert cache.stats()["spilled"] == 1
+    assert cache.get(("a", 1)) == {"a": 1}
+    cache.put(("a", 2), {"a": 2})
+    assert cache.get(("a", 1)) is None
+    cache.clear()
+    assert os.listdir(str(tmp_path / "spill")) == []
+
+def test_io_load_cache_evict():
+    cache = miscset.io.LoadCache(max_bytes = 1)
+    for i in range(10):
+        cache.put((i, 1), [i])
+    assert cache.stats()["entries"] == 1
+    assert len(cache._keys) == 1
+    cache.put((None, 1), None)
+    assert cache.get((None, 1), "missing") is None
+
+def test_io_load_reload(tmp_path):
+    path = str(tmp_path / "data")
+    miscset.io.write_json(path, {"a": 1})
+    assert miscset.io.load(path) is miscset.io.load(path)
+    miscset.io.write_json(path, {"a": 22})
+    assert miscset.io.load(path) == {"a": 22}
+    miscset.io.write_json(path, None)
+    hits = miscset.io.load_cache.hits
+    assert miscset.io.load(path, "json") is None
+    assert miscset.io.load(path, "json") is None
+    assert miscset.io.load_cache.hits == hits + 1
+
+def test_io_read_many_concat(tmp_path):
+    paths = []
+    for i in range(5):
+        path = str(tmp_path / f"{i}.csv")
+        miscset.io.write_txt(f"a,b\n{i},x\n{i},y\n", path)
+        paths.append(path)
+    df = miscset.io.read_many(paths, reader = "csv", workers = 2, concat = True)
+    assert df["a"].tolist() == [0, 0, 1, 1, 2, 2, 3, 3, 4, 4]
+    assert df["source"].tolist()[-1] == paths[-1]
+
+def test_io_read_many_unordered():
+    paths = ["tests/example.json", "tests/example.yml"]
+    results = miscset.io.read_many(paths, ordered = False, executor = "process")
+    assert len(results) == 2
+
+def test_io_read_many_cache():
+    paths = ["tests/example.json", "tests/example.yml"]
+    miscset.io.load_cache.clear()
+    miscset.io.read_many(paths)
+    assert miscset.io.load_cache.stats()["entries"] == 0
+    miscset.io.read_many(paths, reader = miscset.io.load)
+    assert miscset.io.load_cache.stats()["entries"] == 2
+
+
+def test_io_read_keys():
+    keys = ["example_list[1]", "$.example_string", "missing"]
+    expected = {"example_list[1]": 2, "$.example_string": "hello, world!", "missing": None}
+    assert miscset.io.read_keys("tests/example.json", keys) == expected
+    assert miscset.io.read_keys("tests/example.yml", keys) == expected
+    assert miscset.io.read_keys("tests/example.yml", "example_list") == [1, 2, 3]
+    nested = miscset.io.read_keys("tests/example.yml", ["example_list", "example_list[2]"])
+    assert nested == {"example_list": [1, 2, 3], "example_list[2]": 3}
+
+def test_io_read_keys_alias(tmp_path):
+    path = str(tmp_path / "doc.yml")
+    miscset.io.write_txt("b: &b {x: 1, y: 0}\nd: {<<: *b, y: 2}\nref: *b\nl: [*b]\n", path)
+    keys = ["d.x", "d.y", "ref", "ref.x", "l[0].y", "b.y", "missing"]
+    expected = {"d.x": 1, "d.y": 2, "ref": {"x": 1, "y": 0}, "ref.x": 1,
+        "l[0].y": 0, "b.y": 0, "missing": None}
+    assert miscset.io.read_keys(path, keys) == expected
+    with pytest.raises(ValueError):
+        miscset.io.read_keys("tests/example.json", "example_list[-1]")
+
+def test_io_read_keys_index(tmp_path):
+    path = str(tmp_path / "doc.json")
+    miscset.io.write_json(path, {"a": {"b.c": [{"d": "]}"}, {"d": 2}]}, "e": None})
+    assert miscset.io.read_keys(path, "a['b.c'][1].d", index = True) == 2
+    index = miscset.io.read_json(path + ".idx")
+    assert len(index["offsets"]) == 4
+    assert miscset.io.read_keys(path, "a['b.c'][0]", index = True) == {"d": "]}"}
+    assert miscset.io.read_keys(path, "e", default = 1, index = True) is None
+
+def test_io_tiff_series(tmp_path):
+    import numpy
+    import tifffile
+    paths = []
+    for i in range(6):
+        path = str(tmp_path / f"{i}.tif")
+        tifffile.imwrite(path, numpy.full((4, 5), i, dtype = numpy.uint16))
+        paths.append(path)
+    with miscset.io.TiffSeries(paths, cache_size = 2, prefetch = 2) as series:
+        assert series.shape == (6, 4, 5)
+        assert series[1][0, 0] == 1
+        window = series[2:5, 1:3, 0]
+        assert window.shape == (3, 2)
+        assert window[:, 0].tolist() == [2, 3, 4]
+        assert numpy.asarray(series)[-1].max() == 5
+        mask = [False, False, True, True, False, False]
+        assert series[mask][:, 0, 0].tolist() == [2, 3]
+        array = numpy.asarray(series)
+        for key in [(Ellipsis, 0, 0), (Ellipsis, 0), (Ellipsis, 1, 2, 3), Ellipsis,
+            (None, 1), (None, Ellipsis, 0), (2, Ellipsis, None)]:
+            assert numpy.array_equal(series[key], array[key])
+        with pytest.raises(IndexError):
+            series[0.5]
+    reads = []
+    with miscset.io.TiffSeries(paths, cache_size = 2, prefetch = 0) as series:
+        read = series._read
+        series._read = lambda i: reads.append(i) or read(i)
+        assert series[0:6][:, 0, 0].tolist() == list(range(6))
+    assert sorted(reads) == list(range(6))
+    tifffile.imwrite(paths[3], numpy.zeros((2, 2), dtype = numpy.uint16))
+    with miscset.io.TiffSeries(paths, prefetch = 0) as series:
+        with pytest.raises(ValueError):
+            series[3]
+
+
+## miscset.sh
+
+
+def test_sh_color_writer():
+    import io
+    red = miscset.sh.AnsiColor.red
+    stream = io.StringIO()
+    with miscset.sh.ColorWriter(stream, colors = True, rules = [("err", red)]) as writer:
+        writer.writelines(["ok", "an error"])
+    assert stream.getvalue().splitlines() == ["ok", red + "an error" + miscset.sh.AnsiColor.reset]
+    stream = io.StringIO()
+    with miscset.sh.ColorWriter(stream) as writer:
+        writer.writelines([("plain", red)])
+    assert stream.getvalue() == "plain" + os.linesep
+
+def test_sh_color_writer_table():
+    import io
+    import pandas
+    stream = io.StringIO()
+    with miscset.sh.ColorWriter(stream, colors = False) as writer:
+        writer.write_table(pandas.DataFrame({"a": [1, 22]}), index = False)
+    assert stream.getvalue().splitlines() == [" a", " 1", "22"]
+
+def test_sh_run_rusage():
+    out = miscset.sh.run("echo hello; exit 3")
+    assert out.stdout == "hello\n"
+    assert out.returncode == 3
+    assert set(out.rusage) == {"utime", "stime", "maxrss", "wall"}
+
+def test_sh_run_limits():
+    assert miscset.sh.run("ulimit -n", limits = {"files": 50}).stdout == "50\n"
+    assert miscset.sh.run("ulimit -n", piped = False, limits = {"files": 60}).stdout == "60\n"
+    hard = miscset.sh.run("ulimit -H -n").stdout
+    assert miscset.sh.run("ulimit -n", limits = {"files": 2**62}).stdout == hard
+    with pytest.raises(Exception):
+        miscset.sh.run("true", limits = {"threads": 1})
+
+def test_sh_run_limits_threads():
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        outs = list(pool.map(lambda i: miscset.sh.run("ulimit -t",
+            limits = {"cpu": 10 + i}).stdout, range(16)))
+    assert outs == [f"{10 + i}\n" for i in range(16)]
+
+def test_sh_run_timeout():
+    import subprocess
+    with pytest.raises(subprocess.TimeoutExpired):
+        miscset.sh.run("sleep 10 & sleep 10", timeout = 0.2)
+
+def test_sh_pipeline():
+    with miscset.sh.pipeline(["cat", "sort", "echo err >&2; uniq -c; exit 2"],
+        input = "b\na\nb\n") as pipe:
+        lines = [ line.split() for line in pipe ]
+    assert lines == [["1", "a"], ["2", "b"]]
+    assert pipe.returncodes == [0, 0, 2]
+    assert pipe.stderr == ["", "", "err\n"]
+
+def test_sh_pipeline_output(tmp_path):
+    path = str(tmp_path / "out.txt")
+    pipe = miscset.sh.pipeline(["seq 1000", "tail -n 1"], output = path)
+    assert pipe.wait() == [0, 0]
+    assert miscset.io.read_txt(path) == "1000\n"
+
+@pytest.fixture
+def fake_ssh(tmp_path, monkeypatch):
+    # an ssh replacement running commands locally, exporting the host name
+    ssh = tmp_path / "ssh"
+    ssh.write_text('#!/bin/sh\nFAKE_HOST="$1"; export FAKE_HOST; shift\neval "$@"\n')
+    ssh.chmod(0o755)
+    monkeypatch.setenv("PATH", str(tmp_path) + os.pathsep + os.environ["PATH"])
+
+def test_sh_broadcast(fake_ssh):
+    hosts = ["a1", "a2", "b1"]
+    df = miscset.sh.broadcast("echo ${FAKE_HOST%?}", hosts, workers = 2)
+    assert df["host"].tolist() == hosts
+    assert df["stdout"].tolist() == ["a\n", "a\n", "b\n"]
+    grouped = miscset.sh.broadcast("echo ${FAKE_HOST%?}", hosts, group = True)
+    assert grouped["count"].tolist() == [2, 1]
+    assert grouped["hosts"][0] == ["a1", "a2"]
+
+def test_sh_broadcast_timeout(fake_ssh):
+    df = miscset.sh.broadcast("sleep 5", ["h1"], timeout = 0.2, retries = 1, backoff = 0)
+    assert df["returncode"][0] is None
+    assert df["attempts"][0] == 2
+
+
+## miscset.tables
+
+
+def test_tables_df_chunks():
+    df = miscset.tables.list_to_df([list(range(1000)), ["x"] * 1000])
+    chunks = list(miscset.tables.df_chunks(df, max_bytes = 10000))
+    assert len(chunks) > 1
+    assert sum(len(chunk) for chunk in chunks) == 1000
+
+def test_tables_chunks_round_trip(tmp_path):
+    batches = [[[1, 2], ["a", "b"]], [[3], ["c"]]]
+    chunks = miscset.tables.iter_list_to_df(batches, ["n", "s"])
+    path = str(tmp_path / "table.csv")
+    assert miscset.tables.write_df_chunks(chunks, path) == 3
+    reader = miscset.io.read_csv(path, chunksize = 2)
+    lists = list(miscset.tables.iter_df_to_list(reader))
+    assert lists == [[[1, 2], ["a", "b"]], [[3], ["c"]]]
+
+def test_tables_rows_budget():
+    rows = ([i, str(i)] for i in range(1000))
+    chunks = list(miscset.tables.iter_list_to_df(rows, ["n", "s"], max_bytes = 20000))
+    assert len(chunks) > 1
+    assert all(chunk.memory_usage(deep = True).sum() <= 20000 for chunk in chunks)
+    assert chunks[-1].index[-1] == 999
+    assert chunks[-1]["s"].tolist()[-1] == "999"
+    records = ({"n": i, "s": str(i)} for i in range(1000))
+    chunks = list(miscset.tables.iter_dict_to_df(records, max_bytes = 20000))
+    assert sum(len(chunk) for chunk in chunks) == 1000
+    assert list(chunks[0].columns) == ["n", "s"]
+
+def test_tables_write_parquet(tmp_path):
+    pytest.importorskip("pyarrow")
+    import pandas
+    chunks = [
+        pandas.DataFrame({"n": [1, 2], "s": ["a", "b"]}),
+        pandas.DataFrame({"n": [3], "s": [float("nan")]}),
+        pandas.DataFrame({"n": [None], "s": [None]}),
+        pandas.DataFrame({"n": [4.5], "s": ["c"]}),
+    ]
+    path = str(tmp_path / "table.parquet")
+    assert miscset.tables.write_df_chunks(chunks, path) == 5
+    df = pandas.read_parquet(path)
+    assert df["n"].tolist()[:3] == [1, 2, 3]
+    assert df["n"].tolist()[4] == 4.5
+    assert df["s"].isna().tolist() == [False, False, True, True, False]
+
+def test_tables_write_parquet_schema(tmp_path):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pandas
+    path = str(tmp_path / "table.parquet")
+    for first in [[None, None], [float("nan"), float("nan")]]:
+        chunks = [pandas.DataFrame({"s": first}), pandas.DataFrame({"s": ["a", "b"]})]
+        with pytest.raises(ValueError):
+            miscset.tables.write_df_chunks(chunks, path)
+        schema = pyarrow.schema([("s", pyarrow.string())])
+        assert miscset.tables.write_df_chunks(chunks, path, schema = schema) == 4
+        assert pandas.read_parquet(path)["s"].tolist()[2:] == ["a", "b"]
+
+
+## miscset.metrics
+
+
+def test_metrics_recording():
+    with miscset.metrics.recording() as registry:
+        miscset.io.read_json("tests/example.json")
+        miscset.files.find("tests")
+    values = registry.to_dict()
+    assert values["histograms"]["io.read_json"]["count"] == 1
+    assert values["counters"]["io.read_json.bytes"] == os.path.getsize("tests/example.json")
+    assert values["counters"]["files.find.entries"] > 0
+    text = registry.to_prometheus()
+    assert "miscset_io_read_json_seconds_count 1" in text
+    assert "# TYPE miscset_io_read_json_bytes_total counter\nmiscset_io_read_json_bytes_total " in text
+
+def test_metrics_disabled():
+    miscset.metrics.registry.reset()
+    miscset.io.read_json("tests/example.json")
+    assert miscset.metrics.registry.to_dict()["histograms"] == {}